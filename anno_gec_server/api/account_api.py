@@ -9,6 +9,7 @@ from api.utils import validate_email
 from api.utils import validate_password
 from api.utils import md5
 from api.utils import get_endpoints_current_user
+from api.session import issue_session_token
 from model.user import User
 from message.account_message import AccountMessage
 from message.user_message import UserMessage
@@ -24,17 +25,10 @@ class AccountApi(remote.Service):
         validate_email(email)
         password = request.password
         validate_password(password)
-        user = User.find_user_by_email(email)
-        if user is not None:
-            raise endpoints.BadRequestException("Email(" + email + ") already exists.")
-
         display_name = request.display_name
         if display_name is None or display_name == '':
             raise endpoints.BadRequestException("Registration failed. Display name is missing.")
-        user = User.find_user_by_display_name(display_name)
-        if user is not None:
-            raise endpoints.BadRequestException("Display name(" + display_name + ") already exists.")
-
+        # email and display name are claimed in one transaction, see User.put_unique.
         user = User.insert_normal_user(email, display_name, md5(password))
         return UserMessage(id=user.key.id())
 
@@ -48,9 +42,11 @@ class AccountApi(remote.Service):
         user = User.find_user_by_email(email)
         if not user:
             raise endpoints.NotFoundException("Authentication failed. User account " + email + " doesn't exist.")
-        if not User.authenticate(email, md5(password)):
+        if user.password != md5(password):
             raise endpoints.UnauthorizedException("Authentication failed. User name and password are not matched.")
-        return UserMessage(id=user.key.id(), display_name=user.display_name)
+        session_token, session_expires = issue_session_token(user)
+        return UserMessage(id=user.key.id(), display_name=user.display_name, session_token=session_token,
+                           session_expires=session_expires)
 
     @endpoints.method(AccountMessage, message_types.VoidMessage, path='account/forgot_detail', http_method='POST',
                       name='account.forgot_detail')
@@ -73,8 +69,11 @@ class AccountApi(remote.Service):
         user = User.find_user_by_email(email)
         if user is not None:
             user.auth_source = auth_source
-            user.display_name = request.display_name
-            user.put()
+            if request.display_name is not None and request.display_name != user.display_name:
+                if not user.change_display_name(request.display_name):
+                    raise endpoints.BadRequestException("Display name(" + request.display_name + ") already exists.")
+            else:
+                user.put()
         else:
             User.insert_user(current_user.email(), request.display_name, auth_source)
         return message_types.VoidMessage()
\ No newline at end of file
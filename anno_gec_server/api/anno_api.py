@@ -8,7 +8,9 @@ import datetime
 import logging
 
 import endpoints
+from google.appengine.api import search
 from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 from protorpc import message_types
 from protorpc import messages
@@ -18,13 +20,19 @@ from message.anno_api_messages import AnnoMessage
 from message.anno_api_messages import AnnoMergeMessage
 from message.anno_api_messages import AnnoListMessage
 from message.anno_api_messages import AnnoResponseMessage
+from message.anno_api_messages import AnnoBatchMessage
+from message.anno_api_messages import AnnoBatchResultMessage
+from message.anno_api_messages import AnnoBatchResponseMessage
 from model.anno import Anno
 from model.vote import Vote
 from model.flag import Flag
-from model.follow_up import FollowUp
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
 from api.utils import anno_js_client_id
 from api.utils import auth_user
-from api.utils import put_search_document
+from api.utils import validate_batch_size
+from api.anno_cache import get_anno_detail
+from api.search_index import mark_search_document_dirty
 
 
 @endpoints.api(name='anno', version='1.0', description='Anno API',
@@ -51,20 +59,19 @@ class AnnoApi(remote.Service):
             user = None
         if request.id is None:
             raise endpoints.BadRequestException('id field is required.')
-        anno = Anno.get_by_id(request.id)
-        if anno is None:
+        # if current user exists, then fetch vote/flag while anno detail is fetched.
+        if user is not None:
+            anno_key = ndb.Key(Anno, request.id)
+            is_my_vote_future = Vote.is_belongs_user_async(anno_key, user)
+            is_my_flag_future = Flag.is_belongs_user_async(anno_key, user)
+        # anno properties, counts and followups are shared by all users, they are cached.
+        anno_resp_message = get_anno_detail(request.id)
+        if anno_resp_message is None:
             raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % request.id)
-            # set anno basic properties
-        anno_resp_message = anno.to_response_message()
-        # set anno association with followups
-        followups = FollowUp.find_by_anno(anno)
-        followup_messages = [entity.to_message() for entity in followups]
-        anno_resp_message.followup_list = followup_messages
         # set anno association with votes/flags
-        # if current user exists, then fetch vote/flag.
         if user is not None:
-            anno_resp_message.is_my_vote = Vote.is_belongs_user(anno, user)
-            anno_resp_message.is_my_flag = Flag.is_belongs_user(anno, user)
+            anno_resp_message.is_my_vote = is_my_vote_future.get_result()
+            anno_resp_message.is_my_flag = is_my_flag_future.get_result()
         return anno_resp_message
 
 
@@ -101,15 +108,15 @@ class AnnoApi(remote.Service):
         if request.query_type == 'by_created':
             return Anno.query_by_app_by_created(request.app, limit, select_projection, curs)
         elif request.query_type == 'by_vote_count':
-            return Anno.query_by_vote_count(request.app)
+            return Anno.query_by_vote_count(request.app, limit, select_projection, curs)
         elif request.query_type == 'by_flag_count':
-            return Anno.query_by_flag_count(request.app)
+            return Anno.query_by_flag_count(request.app, limit, select_projection, curs)
         elif request.query_type == 'by_activity_count':
-            return Anno.query_by_activity_count(request.app)
+            return Anno.query_by_activity_count(request.app, limit, select_projection, curs)
         elif request.query_type == 'by_last_activity':
-            return Anno.query_by_last_activity(request.app)
+            return Anno.query_by_last_activity(request.app, limit, select_projection, curs)
         elif request.query_type == 'by_country':
-            return Anno.query_by_country(request.app)
+            return Anno.query_by_country(request.app, limit, select_projection, curs)
         else:
             return Anno.query_by_page(limit, select_projection, curs)
 
@@ -120,17 +127,40 @@ class AnnoApi(remote.Service):
         Exposes an API endpoint to insert an anno for the current user.
 
         if current user doesn't exist, the user will be created first.
+        Only the anno entity is committed here, country lookup and search indexing run in background.
         """
         user = auth_user(self.request_state.headers)
-        exist_anno = Anno.is_anno_exists(user, request)
-        if exist_anno is not None:
-            raise endpoints.BadRequestException("Duplicate anno(%s) already exists." % exist_anno.key.id())
+        # duplicate anno is rejected by insert_anno.
         entity = Anno.insert_anno(request, user)
+        UserAppSet.add_app_name(user.key, entity.app_name)
+        UserAnnoActivity.record(user.key, entity.key, 'anno', entity.created)
+        return entity.to_response_message()
 
-        # index this document. strange exception here.
-        put_search_document(entity.generate_search_document())
 
-        return entity.to_response_message()
+    @endpoints.method(AnnoBatchMessage, AnnoBatchResponseMessage, path='anno/batch', http_method='POST',
+                      name='anno.batch_insert')
+    def anno_batch_insert(self, request):
+        """
+        Exposes an API endpoint to insert a batch of annos for the current user.
+
+        Results are returned per item in request order, duplicate annos are reported as item errors.
+        Country lookup and search indexing of the batch run in one background task.
+        """
+        user = auth_user(self.request_state.headers)
+        validate_batch_size(request.anno_list)
+        results = Anno.insert_annos(request.anno_list, user)
+
+        entities = [entity for entity, _ in results if entity is not None]
+        for app_name in set(entity.app_name for entity in entities):
+            UserAppSet.add_app_name(user.key, app_name)
+        if len(entities) > 0:
+            UserAnnoActivity.record_multi(user.key, [(entity.key, 'anno', entity.created) for entity in entities])
+        creators = {user.key: user.to_message()}
+        result_list = []
+        for entity, error in results:
+            anno = entity.to_response_message(creators) if entity is not None else None
+            result_list.append(AnnoBatchResultMessage(anno=anno, error=error))
+        return AnnoBatchResponseMessage(result_list=result_list)
 
 
     anno_update_resource_container = endpoints.ResourceContainer(
@@ -155,9 +185,12 @@ class AnnoApi(remote.Service):
         # set last update time & activity
         anno.last_update_time = datetime.datetime.now()
         anno.last_activity = 'anno'
-        anno.put()
+        exist_anno_key = anno.put_merged()
+        if exist_anno_key is not None:
+            raise endpoints.BadRequestException("Duplicate anno(%s) already exists." % exist_anno_key.id())
+        Anno.invalidate_cache(anno.key.id())
         # update search document.
-        put_search_document(anno.generate_search_document())
+        mark_search_document_dirty(anno.key.id())
         return anno.to_response_message()
 
     @endpoints.method(anno_with_id_resource_container, message_types.VoidMessage, path='anno/{id}',
@@ -175,44 +208,47 @@ class AnnoApi(remote.Service):
         Anno.delete(anno)
         return message_types.VoidMessage()
 
-    @endpoints.method(message_types.VoidMessage, AnnoListMessage, path='anno_my_stuff', http_method='GET',
+    anno_my_stuff_resource_container = endpoints.ResourceContainer(
+        message_types.VoidMessage,
+        cursor=messages.StringField(2),
+        limit=messages.IntegerField(3)
+    )
+
+    @endpoints.method(anno_my_stuff_resource_container, AnnoListMessage, path='anno_my_stuff', http_method='GET',
                       name='anno.mystuff')
     def anno_my_stuff(self, request):
         """
-        Exposes an API endpoint to return all my anno list.
+        Exposes an API endpoint to return my anno list, the annos I created, voted, flagged or followed up,
+        most recent interaction first.
         """
         user = auth_user(self.request_state.headers)
-        anno_list = Anno.query_anno_by_author(user)
-        vote_list = Vote.query_vote_by_author(user)
-        for vote in vote_list:
-            anno = Anno.get_by_id(vote.anno_key.id())
-            if anno is not None:
-                anno_list.append(anno)
-        flag_list = Flag.query_flag_by_author(user)
-        for flag in flag_list:
-            anno = Anno.get_by_id(flag.anno_key.id())
-            if anno is not None:
-                anno_list.append(anno)
-        followup_list = FollowUp.query_followup_by_author(user)
-        for followup in followup_list:
-            anno = Anno.get_by_id(followup.anno_key.id())
-            if anno is not None:
-                anno_list.append(anno)
-        anno_set = list(set(anno_list))
-
-        anno_message_list = []
-        for anno in anno_set:
-            anno_message_list.append(anno.to_response_message())
-        return AnnoListMessage(anno_list=anno_message_list)
+        limit = 10
+        if request.limit is not None:
+            limit = request.limit
+
+        curs = None
+        if request.cursor is not None:
+            try:
+                curs = Cursor(urlsafe=request.cursor)
+            except BadValueError:
+                raise endpoints.BadRequestException('Invalid cursor %s.' % request.cursor)
+
+        annos, next_curs, more = UserAnnoActivity.query_by_user(user, limit, curs)
+        items = Anno.to_response_messages(annos)
+        if more and next_curs is not None:
+            return AnnoListMessage(anno_list=items, cursor=next_curs.urlsafe(), has_more=more)
+        else:
+            return AnnoListMessage(anno_list=items, has_more=False)
 
     anno_search_resource_container = endpoints.ResourceContainer(
         search_string=messages.StringField(1, required=False),
         app_name=messages.StringField(2, required=False),
         order_type=messages.StringField(3, required=True),
-        cursor=messages.StringField(4),  # can't make it work, not sure why. may check it in the future.
+        cursor=messages.StringField(4),  # search cursor returned by previous page.
         limit=messages.IntegerField(5),
-        offset=messages.IntegerField(6),
-        only_my_apps=messages.BooleanField(7)
+        offset=messages.IntegerField(6),  # deprecated, use cursor instead. kept for backward compatibility.
+        only_my_apps=messages.BooleanField(7),
+        index_only=messages.BooleanField(8)  # serve results from search documents only, no datastore access.
     )
 
     @endpoints.method(anno_search_resource_container, AnnoListMessage, path='anno_search', http_method='GET',
@@ -229,29 +265,30 @@ class AnnoApi(remote.Service):
             raise endpoints.BadRequestException(
                 'Invalid order_type field value, valid values are "recent", "active" and "popular"')
 
+        curs = None
+        if request.cursor is not None:
+            try:
+                curs = search.Cursor(web_safe_string=request.cursor)
+            except ValueError:
+                raise endpoints.BadRequestException('Invalid cursor %s.' % request.cursor)
+
         app_set = None
         logging.info("only_my_apps=%s" % request.only_my_apps)
         if request.only_my_apps:
-            app_set = set()
-            for anno in Anno.query_anno_by_author(user):
-                app_set.add(anno.app_name)
-            for vote in Vote.query_vote_by_author(user):
-                anno = Anno.get_by_id(vote.anno_key.id())
-                if anno is not None:
-                    app_set.add(anno.app_name)
-            for flag in Flag.query_flag_by_author(user):
-                anno = Anno.get_by_id(flag.anno_key.id())
-                if anno is not None:
-                    app_set.add(anno.app_name)
-            for followup in FollowUp.query_followup_by_author(user):
-                anno = Anno.get_by_id(followup.anno_key.id())
-                if anno is not None:
-                    app_set.add(anno.app_name)
+            app_set = UserAppSet.get_app_names(user)
 
+        index_only = bool(request.index_only)
         if request.order_type == 'popular':
-            return Anno.query_by_popular(request.limit, request.offset,
-                                         request.search_string, request.app_name, app_set)
+            query_method = Anno.query_by_popular
         elif request.order_type == 'active':
-            return Anno.query_by_active(request.limit, request.offset, request.search_string, request.app_name, app_set)
+            query_method = Anno.query_by_active
         else:
-            return Anno.query_by_recent(request.limit, request.offset, request.search_string, request.app_name, app_set)
+            query_method = Anno.query_by_recent
+        try:
+            return query_method(request.limit, request.offset, request.search_string, request.app_name, app_set,
+                                index_only, curs)
+        except (search.Error, ValueError):
+            # search cursor isn't validated until it's used by the search.
+            if curs is None:
+                raise
+            raise endpoints.BadRequestException('Invalid cursor %s.' % request.cursor)
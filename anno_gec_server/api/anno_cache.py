@@ -0,0 +1,92 @@
+__author__ = 'topcircler'
+
+"""
+Memcache read-through cache of anno detail (the anno.get response).
+
+Only the user-independent part of the response is cached: anno fields, counter totals and followup list,
+is_my_vote/is_my_flag are computed per request. Entries are keyed by anno id and anno cache generation,
+writes invalidate them by bumping the generation (see Anno.invalidate_cache), so a stale entry is never
+read again and just expires.
+
+Hit/miss counters are kept in memcache, see get_anno_cache_stats.
+"""
+
+import time
+
+from google.appengine.api import memcache
+from protorpc import protojson
+
+from message.anno_api_messages import AnnoResponseMessage
+from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
+from model.follow_up import FollowUp
+
+CACHE_TIME = 600  # seconds, it also bounds staleness of creator information.
+FOLLOWUP_PAGE_SIZE = 20  # followups embedded in anno detail, the rest are paged by followup.list.
+STATS_PREFIX = "anno_cache_stats:"
+
+
+def get_generation(anno_id):
+    """
+    Returns current cache generation of the given anno, None if memcache is unavailable.
+    """
+    generation_key = Anno.get_cache_generation_key(anno_id)
+    generation = memcache.get(generation_key)
+    if generation is None:
+        # start from current time, so that entries of an evicted generation are not read again.
+        memcache.add(generation_key, int(time.time() * 1000))
+        generation = memcache.get(generation_key)
+    return generation
+
+
+def build_anno_detail(anno_id):
+    """
+    Build the user-independent part of anno detail, returns None if anno doesn't exist.
+    """
+    anno = Anno.get_by_id(anno_id)
+    if anno is None:
+        return None
+    # followups are queried while anno creator and counters are fetched.
+    followups_future = FollowUp.query_by_anno_async(anno.key, FOLLOWUP_PAGE_SIZE)
+    anno_resp_message = anno.to_response_message()
+    # counts on anno are rolled up periodically, use up-to-date counter totals.
+    counts = AnnoCounterShard.get_counts(anno)
+    anno_resp_message.vote_count = counts['vote_count']
+    anno_resp_message.flag_count = counts['flag_count']
+    anno_resp_message.followup_count = counts['followup_count']
+    anno_resp_message.activity_count = sum(counts.values())
+    # set anno association with the first page of followups
+    followups, next_curs, more = followups_future.get_result()
+    creators = FollowUp.resolve_creators(followups)
+    anno_resp_message.followup_list = [entity.to_message(creators) for entity in followups]
+    if more and next_curs is not None:
+        anno_resp_message.followup_cursor = next_curs.urlsafe()
+    return anno_resp_message
+
+
+def get_anno_detail(anno_id):
+    """
+    Get the user-independent part of anno detail from cache, build and cache it on miss.
+    Returns None if anno doesn't exist.
+    """
+    generation = get_generation(anno_id)
+    cache_key = None
+    if generation is not None:
+        cache_key = "anno_detail:%d:%d" % (anno_id, generation)
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            memcache.incr(STATS_PREFIX + "hits", initial_value=0)
+            return protojson.decode_message(AnnoResponseMessage, cached)
+    memcache.incr(STATS_PREFIX + "misses", initial_value=0)
+    anno_resp_message = build_anno_detail(anno_id)
+    if anno_resp_message is not None and cache_key is not None:
+        memcache.add(cache_key, protojson.encode_message(anno_resp_message), time=CACHE_TIME)
+    return anno_resp_message
+
+
+def get_anno_cache_stats():
+    """
+    Returns (hits, misses) of anno detail cache since memcache was last flushed.
+    """
+    stats = memcache.get_multi(["hits", "misses"], key_prefix=STATS_PREFIX)
+    return stats.get("hits") or 0, stats.get("misses") or 0
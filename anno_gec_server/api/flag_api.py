@@ -1,7 +1,5 @@
 __author__ = 'topcircler'
 
-import datetime
-
 import endpoints
 from protorpc import remote
 from protorpc import message_types
@@ -11,11 +9,17 @@ from google.appengine.ext.db import BadValueError
 
 from message.flag_message import FlagMessage
 from message.flag_message import FlagListMessage
+from message.flag_message import FlagBatchMessage
+from message.flag_message import FlagBatchResultMessage
+from message.flag_message import FlagBatchResponseMessage
 from model.flag import Flag
 from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
 from api.utils import anno_js_client_id
 from api.utils import auth_user
-from api.utils import put_search_document
+from api.keyed_batch import batch_insert
 
 
 @endpoints.api(name='flag', version='1.0', description='Flag API',
@@ -36,24 +40,30 @@ class FlagApi(remote.Service):
         if anno is None:
             raise endpoints.NotFoundException('No anno entity with the id "%s" exists.')
 
-        flag = Flag()
-        flag.anno_key = anno.key
-        flag.creator = user.key
-        if request.created is not None:
-            flag.created = request.created
-        flag.put()
-
-        anno.flag_count += 1
-        anno.last_update_time = datetime.datetime.now()
-        anno.last_activity = 'flag'
-        anno.last_update_type = 'create'
-        anno.put()
+        # a user can flag an anno only once, inserting again returns the existing flag.
+        flag, inserted = Flag.insert(anno.key, user.key, request.created)
+        if not inserted:
+            return flag.to_message()
 
-        # update flag in search document
-        put_search_document(anno.generate_search_document())
+        # flag count, last activity and search document are rolled up into anno by the counter.
+        AnnoCounterShard.increment(anno, 'flag_count')
+        UserAppSet.add_app_name(user.key, anno.app_name)
+        UserAnnoActivity.record(user.key, anno.key, 'flag', flag.created)
 
         return flag.to_message()
 
+
+    @endpoints.method(FlagBatchMessage, FlagBatchResponseMessage, path='flag/batch', http_method='POST',
+                      name='flag.batch_insert')
+    def flag_batch_insert(self, request):
+        """
+        Exposes an API endpoint to insert a batch of flags for the current user.
+        Results are returned per item in request order, flagging an anno twice returns the existing flag.
+        """
+        user = auth_user(self.request_state.headers)
+        results = batch_insert(Flag, request.flag_list, user, FlagBatchResultMessage, 'flag')
+        return FlagBatchResponseMessage(result_list=results)
+
     flag_with_id_resource_container = endpoints.ResourceContainer(
         message_types.VoidMessage,
         id=messages.IntegerField(2),
@@ -71,21 +81,23 @@ class FlagApi(remote.Service):
         if request.id is None and request.anno_id is None:
             raise endpoints.BadRequestException('id or anno_id field is required.')
         if request.id is not None:
-            flag = Flag.get_by_id(request.id)
+            flag = Flag.get_by_message_id(request.id, user)
             if flag is None:
                 raise endpoints.NotFoundException('No flag entity with the id "%s" exists.' % request.id)
 
             anno = flag.anno_key.get()
-            flag.key.delete()
-            anno.flag_count -= 1
-            anno.put()
+            deleted = Flag.delete_by_user(flag.anno_key, flag.creator)
+            if deleted > 0:
+                AnnoCounterShard.increment(anno, 'flag_count', -deleted)
+                UserAnnoActivity.remove(flag.creator, flag.anno_key, 'flag')
         elif request.anno_id is not None:
             anno = Anno.get_by_id(request.anno_id)
-            for key in Flag.query(Flag.anno_key == anno.key, Flag.creator == user.key).iter(keys_only=True):
-                key.delete()
-                anno.flag_count -= 1
-                anno.put()
-        put_search_document(anno.generate_search_document())
+            if anno is None:
+                raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % request.anno_id)
+            deleted = Flag.delete_by_user(anno.key, user.key)
+            if deleted > 0:
+                AnnoCounterShard.increment(anno, 'flag_count', -deleted)
+                UserAnnoActivity.remove(user.key, anno.key, 'flag')
         return message_types.VoidMessage()
 
     @endpoints.method(flag_with_id_resource_container, FlagMessage, http_method='GET', path='flag/{id}',
@@ -97,7 +109,7 @@ class FlagApi(remote.Service):
         user = auth_user(self.request_state.headers)
         if request.id is None:
             raise endpoints.BadRequestException('id field is required.')
-        flag = Flag.get_by_id(request.id)
+        flag = Flag.get_by_message_id(request.id, user)
         if flag is None:
             raise endpoints.NotFoundException('No flag entity with the id "%s" exists.' % request.id)
         return flag.to_message()
@@ -130,7 +142,8 @@ class FlagApi(remote.Service):
         else:
             flags, next_curs, more = Flag.query().fetch_page(limit)
 
-        items = [entity.to_message() for entity in flags]
+        creators = Flag.resolve_creators(flags)
+        items = [entity.to_message(creators) for entity in flags]
         if more:
             return FlagListMessage(flag_list=items, cursor=next_curs.urlsafe(), has_more=more)
         else:
@@ -1,21 +1,44 @@
 __author__ = 'topcircler'
 
-import datetime
-
 import endpoints
 from protorpc import remote
 from protorpc import messages
 from protorpc import message_types
 from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
 
 from api.utils import anno_js_client_id
 from api.utils import auth_user
+from api.utils import validate_batch_size
 from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
 from model.follow_up import FollowUp
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
 from message.followup_message import FollowupMessage
 from message.followup_message import FollowupListMessage
-from api.utils import put_search_document
+from message.followup_message import FollowupBatchMessage
+from message.followup_message import FollowupBatchResultMessage
+from message.followup_message import FollowupBatchResponseMessage
+
+
+def get_followup(followup_id, anno_id):
+    """
+    Get a followup by the id and anno id of FollowupMessage, raise an endpoints exception if there is none.
+    Without anno id only legacy followups can be found, followups which are children of anno need anno id.
+    """
+    if followup_id is None:
+        raise endpoints.BadRequestException('id field is required.')
+    if anno_id is None and FollowUp.LEGACY_KEYS_MIGRATED:
+        raise endpoints.BadRequestException('anno_id field is required.')
+    followup = FollowUp.get_by_message_id(followup_id, anno_id)
+    if followup is None and anno_id is None:
+        raise endpoints.BadRequestException('No legacy follow up entity with the id "%s" exists, '
+                                            'anno_id field is required.' % followup_id)
+    if followup is None:
+        raise endpoints.NotFoundException('No follow up entity with the id "%s" exists.' % followup_id)
+    return followup
 
 
 @endpoints.api(name='followup', version='1.0', description='Followup API',
@@ -36,7 +59,7 @@ class FollowupApi(remote.Service):
         if anno is None:
             raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % request.id)
 
-        followup = FollowUp()
+        followup = FollowUp(parent=anno.key)
         followup.anno_key = anno.key
         followup.creator = user.key
         followup.comment = request.comment
@@ -44,18 +67,58 @@ class FollowupApi(remote.Service):
             followup.created = request.created
         followup.put()
 
-        anno.followup_count += 1
-        anno.last_update_time = datetime.datetime.now()
-        anno.last_activity = 'follwup'
-        anno.last_update_type = 'create'
-        anno.put()
-        # update search document
-        put_search_document(anno.generate_search_document())
+        # followup count, last activity and search document are rolled up into anno by the counter.
+        AnnoCounterShard.increment(anno, 'followup_count')
+        UserAppSet.add_app_name(user.key, anno.app_name)
+        UserAnnoActivity.record(user.key, anno.key, 'followup', followup.created)
         return followup.to_message()
 
+    @endpoints.method(FollowupBatchMessage, FollowupBatchResponseMessage, path='followup/batch', http_method='POST',
+                      name='followup.batch_insert')
+    def followup_batch_insert(self, request):
+        """
+        Exposes an API endpoint to insert a batch of follow ups for the current user.
+        Results are returned per item in request order.
+        """
+        user = auth_user(self.request_state.headers)
+        validate_batch_size(request.followup_list)
+
+        anno_keys = [ndb.Key(Anno, item.anno_id) if item.anno_id is not None else None
+                     for item in request.followup_list]
+        annos = dict((anno.key, anno) for anno in ndb.get_multi([key for key in anno_keys if key is not None])
+                     if anno is not None)
+        results = [None] * len(request.followup_list)
+        items = []
+        for index, (item, anno_key) in enumerate(zip(request.followup_list, anno_keys)):
+            if anno_key not in annos:
+                error = 'No anno entity with the id "%s" exists.' % item.anno_id
+                results[index] = FollowupBatchResultMessage(error=error)
+                continue
+            followup = FollowUp(parent=anno_key, anno_key=anno_key, creator=user.key, comment=item.comment)
+            if item.created is not None:
+                followup.created = item.created
+            items.append((index, followup))
+        ndb.put_multi([followup for _, followup in items])
+
+        creators = {user.key: user.to_message()}
+        followup_counts = {}
+        for index, followup in items:
+            results[index] = FollowupBatchResultMessage(followup=followup.to_message(creators))
+            followup_counts[followup.anno_key] = followup_counts.get(followup.anno_key, 0) + 1
+        # followup count, last activity and search document are rolled up into anno by the counter.
+        for anno_key, count in followup_counts.iteritems():
+            AnnoCounterShard.increment(annos[anno_key], 'followup_count', count)
+        for app_name in set(annos[anno_key].app_name for anno_key in followup_counts):
+            UserAppSet.add_app_name(user.key, app_name)
+        if len(items) > 0:
+            UserAnnoActivity.record_multi(user.key, [(followup.anno_key, 'followup', followup.created)
+                                                     for _, followup in items])
+        return FollowupBatchResponseMessage(result_list=results)
+
     followup_with_id_resource_container = endpoints.ResourceContainer(
         message_types.VoidMessage,
-        id=messages.IntegerField(2, required=True)
+        id=messages.IntegerField(2, required=True),
+        anno_id=messages.IntegerField(3)  # required for followups which are children of anno, see get_followup.
     )
 
     @endpoints.method(followup_with_id_resource_container, message_types.VoidMessage, path='followup/{id}',
@@ -65,15 +128,11 @@ class FollowupApi(remote.Service):
         Exposes an API endpoint to delete an existing follow up.
         """
         user = auth_user(self.request_state.headers)
-        if request.id is None:
-            raise endpoints.BadRequestException('id field is required.')
-        followup = FollowUp.get_by_id(request.id)
-        if followup is None:
-            raise endpoints.NotFoundException('No follow up entity with the id "%s" exists.' % request.id)
+        followup = get_followup(request.id, request.anno_id)
         anno = followup.anno_key.get()
-        followup.key.delete()
-        anno.followup_count -= 1
-        anno.put()
+        FollowUp.delete_multi([followup.key])
+        AnnoCounterShard.increment(anno, 'followup_count', -1)
+        UserAnnoActivity.remove(followup.creator, followup.anno_key, 'followup')
         return message_types.VoidMessage()
 
 
@@ -84,17 +143,14 @@ class FollowupApi(remote.Service):
         Exposes an API endpoint to get a followup.
         """
         user = auth_user(self.request_state.headers)
-        if request.id is None:
-            raise endpoints.BadRequestException('id field is required.')
-        followup = FollowUp.get_by_id(request.id)
-        if followup is None:
-            raise endpoints.NotFoundException('No follow up entity with the id "%s" exists.' % request.id)
+        followup = get_followup(request.id, request.anno_id)
         return followup.to_message()
 
     followup_list_resource_container = endpoints.ResourceContainer(
         message_types.VoidMessage,
         cursor=messages.StringField(2),
-        limit=messages.IntegerField(3)
+        limit=messages.IntegerField(3),
+        anno_id=messages.IntegerField(4)
     )
 
     @endpoints.method(followup_list_resource_container, FollowupListMessage, path='followup', http_method='GET',
@@ -102,6 +158,9 @@ class FollowupApi(remote.Service):
     def followup_list(self, request):
         """
         Exposes an API endpoint to retrieve a list of follow up.
+
+        If anno_id is specified, followups of the anno are listed in created order, otherwise all followups
+        are listed, newest first.
         """
         user = auth_user(self.request_state.headers)
         limit = 10
@@ -115,13 +174,17 @@ class FollowupApi(remote.Service):
             except BadValueError:
                 raise endpoints.BadRequestException('Invalid cursor %s.' % request.cursor)
 
-        query = FollowUp.query().order(-FollowUp.created)
-        if curs is not None:
-            followups, next_curs, more = query.fetch_page(limit, start_cursor=curs)
+        if request.anno_id is not None:
+            followups, next_curs, more = FollowUp.query_by_anno(ndb.Key(Anno, request.anno_id), limit, curs)
         else:
-            followups, next_curs, more = query.fetch_page(limit)
-
-        items = [entity.to_message() for entity in followups]
+            query = FollowUp.query().order(-FollowUp.created)
+            if curs is not None:
+                followups, next_curs, more = query.fetch_page(limit, start_cursor=curs)
+            else:
+                followups, next_curs, more = query.fetch_page(limit)
+
+        creators = FollowUp.resolve_creators(followups)
+        items = [entity.to_message(creators) for entity in followups]
         if more:
             return FollowupListMessage(followup_list=items, cursor=next_curs.urlsafe(), has_more=more)
         else:
@@ -0,0 +1,248 @@
+__author__ = 'topcircler'
+
+"""
+Offline reverse geocoder which looks up country by coordinate.
+
+Country boundaries are loaded from COUNTRY_BOUNDARIES_FILE, a GeoJSON FeatureCollection of country
+polygons, the country name is read from the feature property 'ADMIN' or 'name'. Polygons are indexed by a
+grid over their bounding boxes, so a lookup only tests the polygons whose bounding box covers the point.
+
+The bundled data/country_boundaries.json holds admin-0 outlines built from OpenStreetMap boundaries
+(timezone-boundary-builder polygons merged by country of zone.tab, territorial waters included), simplified
+to about 1km. Disputed areas follow the country of their time zone(e.g. Kosovo is matched as Serbia). It can
+be replaced by any GeoJSON of the same shape (e.g. Natural Earth "Admin 0 - Countries").
+Its 'name' properties are the long_name google map returns, so offline and fallback lookups store the same
+country names. Features are ordered by size, so a small country is matched before a bigger outline which
+overlaps it.
+
+Simplified outlines can put a point near a border into the wrong country, so a point within BORDER_TOLERANCE
+of its polygon's edge isn't trusted. Results are cached by geohash bucket in an in-process LRU and in memcache.
+If no polygon contains the point far enough from its edge (or the boundaries file isn't deployed), the google
+map geocoder is used as fallback.
+"""
+
+import collections
+import json
+import logging
+import math
+import os
+import threading
+
+from google.appengine.api import memcache
+
+from api.utils import get_country_by_coordinate
+from api.utils import NO_COUNTRY_RESULT
+
+COUNTRY_BOUNDARIES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                       'data', 'country_boundaries.json')
+GRID_CELL_SIZE = 5.0  # degrees
+BORDER_TOLERANCE = 0.02  # degrees of latitude(about 2km), twice the simplification error of the bundled outlines.
+GEOHASH_PRECISION = 6  # about 1.2km x 0.6km bucket
+LRU_CACHE_SIZE = 10000
+MEMCACHE_TIME = 7 * 24 * 3600
+NO_COUNTRY = ''  # cached value for coordinates which are not in any country.
+
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Encode coordinate into geohash string.
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        value_range, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def _ring_contains(ring, x, y):
+    """
+    Ray casting test of point(x=longitude, y=latitude) against a polygon ring.
+    """
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+
+def _ring_near(ring, x, y, tolerance, x_scale):
+    """
+    Whether point(x=longitude, y=latitude) is within tolerance of an edge of a polygon ring.
+    Longitude differences are multiplied by x_scale, so the distance is measured in degrees of latitude.
+    """
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        j = i
+        if min(yi, yj) - tolerance > y or max(yi, yj) + tolerance < y:
+            continue
+        # edge and point in scaled coordinates relative to the start of the edge.
+        dx, dy = (xj - xi) * x_scale, yj - yi
+        px, py = (x - xi) * x_scale, y - yi
+        length = dx * dx + dy * dy
+        t = 0.0 if length == 0 else max(0.0, min(1.0, (px * dx + py * dy) / length))
+        if (px - t * dx) ** 2 + (py - t * dy) ** 2 <= tolerance * tolerance:
+            return True
+    return False
+
+
+class CountryIndex(object):
+    """
+    Spatial index of country polygons.
+    """
+
+    def __init__(self, features):
+        # each polygon is (country name, bounding box, rings), the first ring is outer boundary, others are holes.
+        self.polygons = []
+        self.grid = collections.defaultdict(list)
+        for feature in features:
+            properties = feature.get('properties') or {}
+            name = properties.get('ADMIN') or properties.get('name')
+            geometry = feature.get('geometry') or {}
+            if name is None:
+                continue
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            for rings in polygons:
+                if len(rings) > 0 and len(rings[0]) > 2:
+                    self._add_polygon(name, rings)
+
+    def _add_polygon(self, name, rings):
+        xs = [point[0] for point in rings[0]]
+        ys = [point[1] for point in rings[0]]
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+        polygon_id = len(self.polygons)
+        self.polygons.append((name, bbox, rings))
+        for cell_x in range(self._cell(bbox[0]), self._cell(bbox[2]) + 1):
+            for cell_y in range(self._cell(bbox[1]), self._cell(bbox[3]) + 1):
+                self.grid[(cell_x, cell_y)].append(polygon_id)
+
+    @staticmethod
+    def _cell(degree):
+        return int(degree // GRID_CELL_SIZE)
+
+    def find_country(self, latitude, longitude, tolerance=BORDER_TOLERANCE):
+        """
+        Returns name of the country which contains the given coordinate, None if there is no such country
+        or the coordinate is within tolerance(degrees) of the country's border.
+        """
+        x, y = longitude, latitude
+        for polygon_id in self.grid.get((self._cell(x), self._cell(y)), []):
+            name, bbox, rings = self.polygons[polygon_id]
+            if not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+                continue
+            if _ring_contains(rings[0], x, y) and not any(_ring_contains(hole, x, y) for hole in rings[1:]):
+                x_scale = math.cos(math.radians(y))
+                if any(_ring_near(ring, x, y, tolerance, x_scale) for ring in rings):
+                    return None
+                return name
+        return None
+
+    @classmethod
+    def load(cls, path=COUNTRY_BOUNDARIES_FILE):
+        """
+        Load country index from a GeoJSON file, returns None if the file doesn't exist.
+        """
+        if not os.path.exists(path):
+            logging.warning("Country boundaries file %s doesn't exist, offline geocoding is disabled." % path)
+            return None
+        with open(path) as boundaries_file:
+            collection = json.load(boundaries_file)
+        index = cls(collection.get('features', []))
+        logging.info("Loaded %d country polygons." % len(index.polygons))
+        return index
+
+
+_country_index = None
+_country_index_loaded = False
+_country_index_lock = threading.Lock()
+_lru_cache = collections.OrderedDict()
+_lru_cache_lock = threading.Lock()
+
+
+def get_country_index():
+    """
+    Returns country index of current instance, it's loaded on first use.
+    """
+    global _country_index, _country_index_loaded
+    if not _country_index_loaded:
+        with _country_index_lock:
+            if not _country_index_loaded:
+                _country_index = CountryIndex.load()
+                _country_index_loaded = True
+    return _country_index
+
+
+def _lru_get(geohash):
+    with _lru_cache_lock:
+        country = _lru_cache.pop(geohash, None)
+        if country is not None:
+            _lru_cache[geohash] = country
+        return country
+
+
+def _lru_put(geohash, country):
+    with _lru_cache_lock:
+        _lru_cache.pop(geohash, None)
+        _lru_cache[geohash] = country
+        while len(_lru_cache) > LRU_CACHE_SIZE:
+            _lru_cache.popitem(last=False)
+
+
+def get_country(latitude, longitude, use_fallback=True):
+    """
+    This function returns country name of the given coordinate, bundled country boundaries are used
+    and external service is called only if the coordinate isn't in any of them or is near a border.
+    A coordinate is cached as in no country only if both the boundaries and google map miss it, nothing is
+    cached if google map fails or isn't used.
+    :param use_fallback: whether to use google map geocoder if country isn't found offline.
+    """
+    geohash = encode_geohash(latitude, longitude)
+    country = _lru_get(geohash)
+    if country is not None:
+        return country if country != NO_COUNTRY else None
+    cache_key = "country:%s" % geohash
+    country = memcache.get(cache_key)
+    if country is None:
+        country_index = get_country_index()
+        if country_index is not None:
+            country = country_index.find_country(latitude, longitude)
+        if country is None and use_fallback:
+            country = get_country_by_coordinate(latitude, longitude)
+            if country == NO_COUNTRY_RESULT:
+                # without boundaries a miss of google map alone isn't trusted.
+                country = NO_COUNTRY if country_index is not None else None
+        if country is None:
+            # the fallback failed, timed out or wasn't used, nothing is known about this coordinate.
+            return None
+        memcache.set(cache_key, country, time=MEMCACHE_TIME)
+    _lru_put(geohash, country)
+    return country if country != NO_COUNTRY else None
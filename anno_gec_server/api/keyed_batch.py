@@ -0,0 +1,56 @@
+__author__ = 'topcircler'
+
+"""
+Batch insert shared by vote and flag APIs, votes and flags are keyed by (user, anno), see LegacyKeyMigrationMixin.
+"""
+
+from google.appengine.ext import ndb
+
+from api.utils import validate_batch_size
+from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
+
+
+def batch_insert(model, batch_items, user, result_message_class, message_field):
+    """
+    Insert a batch of votes or flags for the given user.
+    Results are returned per item in request order, inserting on an anno twice returns the existing entity.
+    :param model: Vote or Flag.
+    :param batch_items: items of the batch request, each of them has anno_id and created.
+    :param result_message_class: batch result message, it holds an error or the entity message in message_field.
+    """
+    validate_batch_size(batch_items)
+
+    anno_keys = [ndb.Key(Anno, item.anno_id) if item.anno_id is not None else None for item in batch_items]
+    annos = dict((anno.key, anno) for anno in ndb.get_multi([key for key in anno_keys if key is not None])
+                 if anno is not None)
+    results = [None] * len(batch_items)
+    items = []
+    for index, (item, anno_key) in enumerate(zip(batch_items, anno_keys)):
+        if anno_key in annos:
+            items.append((index, annos[anno_key], item.created))
+        else:
+            error = 'No anno entity with the id "%s" exists.' % item.anno_id
+            results[index] = result_message_class(error=error)
+
+    creators = {user.key: user.to_message()}
+    inserted_entities = []
+    entity_results = model.insert_multi([anno.key for _, anno, _ in items], user.key,
+                                        [created for _, _, created in items])
+    for (index, anno, _), (entity, inserted) in zip(items, entity_results):
+        results[index] = result_message_class(**{message_field: entity.to_message(creators)})
+        if inserted:
+            inserted_entities.append((anno, entity))
+
+    # counts, last activity and search document are rolled up into anno by the counter.
+    activity = AnnoCounterShard.METRICS[model.COUNTER_METRIC]
+    for anno, _ in inserted_entities:
+        AnnoCounterShard.increment(anno, model.COUNTER_METRIC)
+    for app_name in set(anno.app_name for anno, _ in inserted_entities):
+        UserAppSet.add_app_name(user.key, app_name)
+    if len(inserted_entities) > 0:
+        UserAnnoActivity.record_multi(user.key, [(anno.key, activity, entity.created)
+                                                 for anno, entity in inserted_entities])
+    return results
@@ -0,0 +1,139 @@
+__author__ = 'topcircler'
+
+"""
+Coalescing updater of anno search documents.
+
+Writes which change an indexed anno field (vote/flag/followup counter roll-up, anno merge, anno enrichment)
+don't put search document by themselves, they mark the anno dirty by adding a task into pull queue
+SEARCH_INDEX_QUEUE. A flush task leases dirty marks, collapses repeated marks of the same anno, regenerates
+documents from the latest anno entities and puts them by batches of SEARCH_INDEX_BATCH_SIZE.
+
+Flush metrics are kept in memcache, see get_search_index_stats.
+"""
+
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+SEARCH_INDEX_NAME = "anno_index"
+SEARCH_INDEX_QUEUE = 'search-index-updates'  # pull queue, see queue.yaml.
+SEARCH_INDEX_BATCH_SIZE = 200  # max documents of one index.put.
+FLUSH_DELAY = 5  # seconds, dirty marks within this window are flushed together.
+FLUSH_LEASE_SIZE = 1000  # max tasks of one lease_tasks.
+FLUSH_LEASE_SECONDS = 120
+STATS_PREFIX = "search_index_stats:"
+
+
+def get_search_index():
+    return search.Index(name=SEARCH_INDEX_NAME)
+
+
+def mark_search_document_dirty(anno_id):
+    """
+    Mark search document of the given anno out of date, it's regenerated by the next flush.
+    """
+    mark_search_documents_dirty([anno_id])
+
+
+def mark_search_documents_dirty(anno_ids):
+    """
+    Mark search documents of the given annos out of date, and schedule a flush.
+    """
+    if len(anno_ids) == 0:
+        return
+    now = time.time()
+    tasks = [taskqueue.Task(method='PULL', payload=json.dumps({'anno_id': anno_id, 'marked': now}))
+             for anno_id in anno_ids]
+    queue = taskqueue.Queue(SEARCH_INDEX_QUEUE)
+    for start in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.add(tasks[start:start + taskqueue.MAX_TASKS_PER_ADD])
+    memcache.incr(STATS_PREFIX + "marked", len(anno_ids), initial_value=0)
+    schedule_flush()
+
+
+def schedule_flush():
+    """
+    Schedule a flush task, all dirty marks within FLUSH_DELAY share one task.
+    """
+    window = int(time.time() / FLUSH_DELAY)
+    try:
+        deferred.defer(flush_search_documents, _countdown=FLUSH_DELAY, _name="search-index-flush-%d" % window)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def flush_search_documents():
+    """
+    Lease dirty marks, and put search documents of the marked annos by batches.
+    Documents of annos which no longer exist are deleted. Leased marks are deleted only after documents are put,
+    if this task fails the marks are leased again when their lease expires.
+    """
+    # imported here since model.anno imports this module.
+    from model.anno import Anno
+
+    queue = taskqueue.Queue(SEARCH_INDEX_QUEUE)
+    tasks = queue.lease_tasks(FLUSH_LEASE_SECONDS, FLUSH_LEASE_SIZE)
+    if len(tasks) == 0:
+        return
+
+    anno_ids = []
+    oldest_mark = None
+    for task in tasks:
+        mark = json.loads(task.payload)
+        if mark['anno_id'] not in anno_ids:
+            anno_ids.append(mark['anno_id'])
+        if oldest_mark is None or mark['marked'] < oldest_mark:
+            oldest_mark = mark['marked']
+
+    annos = ndb.get_multi([ndb.Key(Anno, anno_id) for anno_id in anno_ids])
+    creators = Anno.resolve_creators(annos)
+    documents = [anno.generate_search_document(creators) for anno in annos if anno is not None]
+    deleted_ids = ["%d" % anno_id for anno_id, anno in zip(anno_ids, annos) if anno is None]
+
+    index = get_search_index()
+    for start in range(0, len(documents), SEARCH_INDEX_BATCH_SIZE):
+        index.put(documents[start:start + SEARCH_INDEX_BATCH_SIZE])
+    for start in range(0, len(deleted_ids), SEARCH_INDEX_BATCH_SIZE):
+        index.delete(deleted_ids[start:start + SEARCH_INDEX_BATCH_SIZE])
+    queue.delete_tasks(tasks)
+
+    lag = time.time() - oldest_mark
+    record_flush(len(tasks), len(anno_ids), lag)
+    logging.info("flushed %d search documents of %d dirty marks, lag %.1fs." % (len(anno_ids), len(tasks), lag))
+
+    if len(tasks) == FLUSH_LEASE_SIZE:
+        # there may be more dirty marks, flush them without waiting.
+        deferred.defer(flush_search_documents)
+
+
+def record_flush(mark_count, document_count, lag):
+    memcache.incr(STATS_PREFIX + "flushes", initial_value=0)
+    memcache.incr(STATS_PREFIX + "flushed_marks", mark_count, initial_value=0)
+    memcache.incr(STATS_PREFIX + "flushed_documents", document_count, initial_value=0)
+    memcache.incr(STATS_PREFIX + "total_lag_ms", int(lag * 1000), initial_value=0)
+    memcache.set_multi({"last_batch_size": document_count, "last_lag_ms": int(lag * 1000),
+                        "last_flush_time": int(time.time())}, key_prefix=STATS_PREFIX)
+    max_lag_ms = memcache.get(STATS_PREFIX + "max_lag_ms")
+    if max_lag_ms is None or lag * 1000 > max_lag_ms:
+        memcache.set(STATS_PREFIX + "max_lag_ms", int(lag * 1000))
+
+
+def get_search_index_stats():
+    """
+    Returns a dict of flush metrics since memcache was last flushed:
+    marked, flushes, flushed_marks, flushed_documents, last_batch_size, last_lag_ms, max_lag_ms, average_lag_ms,
+    last_flush_time and pending_marks(approximate count of marks in pull queue).
+    """
+    stats = memcache.get_multi(["marked", "flushes", "flushed_marks", "flushed_documents", "total_lag_ms",
+                                "last_batch_size", "last_lag_ms", "max_lag_ms", "last_flush_time"],
+                               key_prefix=STATS_PREFIX)
+    flushes = stats.get("flushes") or 0
+    stats["average_lag_ms"] = stats.pop("total_lag_ms", 0) / flushes if flushes > 0 else None
+    stats["pending_marks"] = taskqueue.Queue(SEARCH_INDEX_QUEUE).fetch_statistics().tasks
+    return stats
@@ -0,0 +1,108 @@
+__author__ = 'topcircler'
+
+"""
+Stateless session tokens.
+
+account.authenticate issues a session token which carries the user id and an expiry time, signed by HMAC-SHA256
+with SessionSecret. Clients send it in SESSION_HEADER, auth_user verifies it in memory and falls back to
+the credential in Authorization header only when it's missing, invalid or expired.
+
+Users resolved from session tokens are cached in an in-process LRU for USER_CACHE_TIME.
+"""
+
+import base64
+import collections
+import hashlib
+import hmac
+import threading
+import time
+
+from model.user import User
+from model.session_secret import SessionSecret
+
+SESSION_HEADER = 'X-Anno-Session'
+SESSION_TTL = 3600  # seconds
+USER_CACHE_SIZE = 1000
+USER_CACHE_TIME = 60  # seconds, it bounds staleness of cached user entities.
+
+_secret = None
+_secret_lock = threading.Lock()
+_user_cache = collections.OrderedDict()
+_user_cache_lock = threading.Lock()
+
+
+def get_secret():
+    """
+    Returns session secret of current instance, it's loaded on first use.
+    """
+    global _secret
+    if _secret is None:
+        with _secret_lock:
+            if _secret is None:
+                _secret = str(SessionSecret.get_secret())
+    return _secret
+
+
+def sign(payload):
+    return hmac.new(get_secret(), payload, hashlib.sha256).hexdigest()
+
+
+def issue_session_token(user):
+    """
+    Issue a session token of the given user, returns (token, expiry time in seconds since epoch).
+    """
+    expires = int(time.time()) + SESSION_TTL
+    payload = "%d:%d" % (user.key.id(), expires)
+    return "%s.%s" % (base64.urlsafe_b64encode(payload), sign(payload)), expires
+
+
+def verify_session_token(token):
+    """
+    Verify signature and expiry of a session token, returns user id or None if the token isn't valid.
+    """
+    try:
+        encoded_payload, signature = str(token).split('.', 1)
+        payload = base64.urlsafe_b64decode(encoded_payload)
+        user_id, expires = [int(part) for part in payload.split(':')]
+    except (TypeError, ValueError):
+        return None
+    if not hmac.compare_digest(sign(payload), signature):
+        return None
+    if expires < time.time():
+        return None
+    return user_id
+
+
+def get_session_user(headers):
+    """
+    Returns user of the session token in request headers, None if there is no valid session token.
+    """
+    token = headers.get(SESSION_HEADER)
+    if token is None:
+        return None
+    user_id = verify_session_token(token)
+    if user_id is None:
+        return None
+    user = _user_cache_get(user_id)
+    if user is None:
+        user = User.get_by_id(user_id)
+        if user is not None:
+            _user_cache_put(user_id, user)
+    return user
+
+
+def _user_cache_get(user_id):
+    with _user_cache_lock:
+        entry = _user_cache.pop(user_id, None)
+        if entry is None or entry[1] < time.time():
+            return None
+        _user_cache[user_id] = entry
+        return entry[0]
+
+
+def _user_cache_put(user_id, user):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+        _user_cache[user_id] = (user, time.time() + USER_CACHE_TIME)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
@@ -0,0 +1,75 @@
+__author__ = 'topcircler'
+
+"""
+Sync API implemented using Google Cloud Endpoints.
+"""
+
+import endpoints
+from google.appengine.ext import ndb
+from protorpc import message_types
+from protorpc import messages
+from protorpc import remote
+
+from message.sync_message import ChangeMessage
+from message.sync_message import ChangeListMessage
+from model.base_model import BaseModel
+from model.entity_change import EntityChange
+from api.utils import anno_js_client_id
+from api.utils import auth_user
+
+
+@endpoints.api(name='sync', version='1.0', description='Sync API',
+               allowed_client_ids=[endpoints.API_EXPLORER_CLIENT_ID, anno_js_client_id])
+class SyncApi(remote.Service):
+    """
+    Class which defines Sync API v1.
+    """
+
+    MAX_LIMIT = 500
+
+    sync_changes_resource_container = endpoints.ResourceContainer(
+        message_types.VoidMessage,
+        since=messages.StringField(2),
+        limit=messages.IntegerField(3)
+    )
+
+    @endpoints.method(sync_changes_resource_container, ChangeListMessage, path='sync/changes', http_method='GET',
+                      name='sync.changes')
+    def sync_changes(self, request):
+        """
+        Exposes an API endpoint to get changes of annos, votes, flags and followups since a sync token.
+
+        A client starts without since to get everything, then passes the returned token as since to get
+        only later changes. An entity changed several times is returned once with its latest state.
+        """
+        user = auth_user(self.request_state.headers)
+        limit = 100
+        if request.limit is not None:
+            limit = min(request.limit, self.MAX_LIMIT)
+        if limit <= 0:
+            raise endpoints.BadRequestException('limit must be positive.')
+
+        try:
+            changes, token, more = EntityChange.query_since(request.since, limit)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid sync token %s.' % request.since)
+
+        live_changes = [change for change in changes if not change.deleted]
+        entities = dict((entity.key, entity) for entity in ndb.get_multi([change.entity_key for change in live_changes])
+                        if entity is not None)
+        creators = BaseModel.resolve_creators(entities.values())
+        items = []
+        for change in changes:
+            item = ChangeMessage(kind=change.kind, key=change.entity_key.urlsafe(), id=change.entity_key.id(),
+                                 anno_id=change.anno_id, version=change.version, updated=change.updated,
+                                 deleted=change.deleted)
+            entity = entities.get(change.entity_key)
+            if entity is None:
+                # the entity is deleted after the change is read, its tombstone comes later.
+                item.deleted = True
+            elif change.kind == 'anno':
+                item.anno = entity.to_response_message(creators)
+            else:
+                setattr(item, change.kind, entity.to_message(creators))
+            items.append(item)
+        return ChangeListMessage(change_list=items, token=token, has_more=more)
@@ -1,17 +1,37 @@
 __author__ = 'topcircler'
 
-import logging
+import datetime
 
 import endpoints
+from google.appengine.ext import deferred
 from protorpc import remote
 from protorpc import message_types
+from protorpc import messages
+from google.appengine.ext import ndb
 
-from api.utils import put_search_document
+from api.search_index import mark_search_documents_dirty
+from api.search_index import get_search_index_stats
+from api.anno_cache import get_anno_cache_stats
 from model.anno import Anno
 from model.appinfo import AppInfo
+from model.vote import Vote
+from model.flag import Flag
+from model.follow_up import FollowUp
+from model.entity_change import EntityChange
+from model.anno_children import sweep_orphans
+from model.counter_reconciler import reconcile_counters
+from model.counter_reconciler import get_reconcile_stats
+from model.user import User
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
 from api.utils import anno_js_client_id
+from api.utils import auth_admin
 from api.utils import is_empty_string
 from message.appinfo_message import AppInfoMessage
+from message.search_index_message import SearchIndexStatsMessage
+from message.anno_cache_message import AnnoCacheStatsMessage
+from message.moderation_message import BulkDeleteResultMessage
+from message.counter_message import CounterReconcileStatsMessage
 
 
 @endpoints.api(name='util', version='1.0', description='Util API',
@@ -27,9 +47,190 @@ class UtilApi(remote.Service):
         """
         Exposes an API endpoint to insert search document for legacy documents.
         """
-        for anno in Anno.query():
-            logging.info("generating search document for anno(%s)." % anno.key.id())
-            put_search_document(anno.generate_search_document())
+        mark_search_documents_dirty([anno_key.id() for anno_key in Anno.query().iter(keys_only=True)])
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.rebuild_user_app_set',
+                      http_method='POST', name='util.rebuild_user_app_set')
+    def rebuild_user_app_set(self, request):
+        """
+        Exposes an API endpoint to rebuild app sets of all users in background.
+        """
+        deferred.defer(UserAppSet.rebuild_all)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.backfill_user_anno_activity',
+                      http_method='POST', name='util.backfill_user_anno_activity')
+    def backfill_user_anno_activity(self, request):
+        """
+        Exposes an API endpoint to build "my stuff" activities of all users in background.
+        """
+        deferred.defer(UserAnnoActivity.backfill)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.migrate_vote_flag_keys',
+                      http_method='POST', name='util.migrate_vote_flag_keys')
+    def migrate_vote_flag_keys(self, request):
+        """
+        Exposes an API endpoint to move legacy votes and flags to keys by (user, anno) in background.
+        """
+        deferred.defer(Vote.migrate_keys)
+        deferred.defer(Flag.migrate_keys)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.migrate_followup_keys',
+                      http_method='POST', name='util.migrate_followup_keys')
+    def migrate_followup_keys(self, request):
+        """
+        Exposes an API endpoint to move legacy followups under their annos in background.
+        """
+        deferred.defer(FollowUp.migrate_to_anno_parent)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.build_user_unique_index',
+                      http_method='POST', name='util.build_user_unique_index')
+    def build_user_unique_index(self, request):
+        """
+        Exposes an API endpoint to claim emails and display names of existing users in background.
+        """
+        deferred.defer(User.build_unique_index)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.sweep_orphans',
+                      http_method='POST', name='util.sweep_orphans')
+    def sweep_anno_orphans(self, request):
+        """
+        Exposes an API endpoint to delete votes, flags, followups and other children of deleted annos in background.
+        """
+        deferred.defer(sweep_orphans)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.backfill_change_log',
+                      http_method='POST', name='util.backfill_change_log')
+    def backfill_change_log(self, request):
+        """
+        Exposes an API endpoint to record existing annos, votes, flags and followups into change log in background.
+        """
+        for kind in ['Anno', 'Vote', 'Flag', 'FollowUp']:
+            deferred.defer(EntityChange.backfill, kind)
+        return message_types.VoidMessage()
+
+    bulk_delete_resource_container = endpoints.ResourceContainer(
+        message_types.VoidMessage,
+        anno_id=messages.IntegerField(2),
+        user_id=messages.IntegerField(3, repeated=True)
+    )
+
+    @endpoints.method(bulk_delete_resource_container, BulkDeleteResultMessage, path='util.bulk_delete_votes',
+                      http_method='POST', name='util.bulk_delete_votes')
+    def bulk_delete_votes(self, request):
+        """
+        Exposes an API endpoint to delete votes on an anno for moderation, votes of the given users are deleted,
+        or all votes on the anno if no user is given. It's only open to administrators.
+        """
+        auth_admin()
+        anno = self.get_anno(request.anno_id)
+        user_keys = [ndb.Key(User, user_id) for user_id in request.user_id] if len(request.user_id) > 0 else None
+        # vote count is decreased with each delete, last activity and search document are rolled up by the counter.
+        creator_keys = Vote.delete_by_anno(anno, user_keys)
+        if len(creator_keys) > 0:
+            deferred.defer(UserAnnoActivity.remove_multi, creator_keys, anno.key, 'vote')
+        return BulkDeleteResultMessage(deleted_count=len(creator_keys))
+
+    @endpoints.method(bulk_delete_resource_container, BulkDeleteResultMessage, path='util.bulk_delete_flags',
+                      http_method='POST', name='util.bulk_delete_flags')
+    def bulk_delete_flags(self, request):
+        """
+        Exposes an API endpoint to delete flags on an anno for moderation, flags of the given users are deleted,
+        or all flags on the anno if no user is given. It's only open to administrators.
+        """
+        auth_admin()
+        anno = self.get_anno(request.anno_id)
+        user_keys = [ndb.Key(User, user_id) for user_id in request.user_id] if len(request.user_id) > 0 else None
+        # flag count is decreased with each delete, last activity and search document are rolled up by the counter.
+        creator_keys = Flag.delete_by_anno(anno, user_keys)
+        if len(creator_keys) > 0:
+            deferred.defer(UserAnnoActivity.remove_multi, creator_keys, anno.key, 'flag')
+        return BulkDeleteResultMessage(deleted_count=len(creator_keys))
+
+    def get_anno(self, anno_id):
+        if anno_id is None:
+            raise endpoints.BadRequestException('anno_id field is required.')
+        anno = Anno.get_by_id(anno_id)
+        if anno is None:
+            raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % anno_id)
+        return anno
+
+    @endpoints.method(message_types.VoidMessage, SearchIndexStatsMessage, path='util.search_index_stats',
+                      http_method='GET', name='util.search_index_stats')
+    def search_index_stats(self, request):
+        """
+        Exposes an API endpoint to get flush lag and batch size metrics of search index updater.
+        """
+        stats = get_search_index_stats()
+        last_flush_time = stats.pop('last_flush_time', None)
+        if last_flush_time is not None:
+            last_flush_time = datetime.datetime.utcfromtimestamp(last_flush_time)
+        return SearchIndexStatsMessage(last_flush_time=last_flush_time, **stats)
+
+    @endpoints.method(message_types.VoidMessage, AnnoCacheStatsMessage, path='util.anno_cache_stats',
+                      http_method='GET', name='util.anno_cache_stats')
+    def anno_cache_stats(self, request):
+        """
+        Exposes an API endpoint to get hit rate of anno detail cache.
+        """
+        hits, misses = get_anno_cache_stats()
+        hit_rate = float(hits) / (hits + misses) if hits + misses > 0 else None
+        return AnnoCacheStatsMessage(hits=hits, misses=misses, hit_rate=hit_rate)
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.reconcile_counters',
+                      http_method='POST', name='util.reconcile_counters')
+    def reconcile_anno_counters(self, request):
+        """
+        Exposes an API endpoint to recompute vote/flag/followup counts of all annos in background.
+        """
+        deferred.defer(reconcile_counters)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, CounterReconcileStatsMessage, path='util.counter_reconcile_stats',
+                      http_method='GET', name='util.counter_reconcile_stats')
+    def counter_reconcile_stats(self, request):
+        """
+        Exposes an API endpoint to get drift statistics of the current or last counter reconciliation.
+        """
+        stats = get_reconcile_stats()
+        if stats is None:
+            return CounterReconcileStatsMessage()
+        for name in ['started_time', 'finished_time']:
+            if stats[name] is not None:
+                stats[name] = datetime.datetime.utcfromtimestamp(stats[name])
+        return CounterReconcileStatsMessage(**stats)
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.migrate_screenshot',
+                      http_method='POST', name='util.migrate_screenshot')
+    def migrate_screenshot(self, request):
+        """
+        Exposes an API endpoint to move legacy screenshots out of anno entities in background.
+        """
+        deferred.defer(Anno.migrate_screenshot)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.backfill_activity_count',
+                      http_method='POST', name='util.backfill_activity_count')
+    def backfill_activity_count(self, request):
+        """
+        Exposes an API endpoint to check and backfill activity_count of existing annos in background.
+        """
+        deferred.defer(Anno.backfill_activity_count)
+        return message_types.VoidMessage()
+
+    @endpoints.method(message_types.VoidMessage, message_types.VoidMessage, path='util.backfill_fingerprint',
+                      http_method='POST', name='util.backfill_fingerprint')
+    def backfill_fingerprint(self, request):
+        """
+        Exposes an API endpoint to compute fingerprint of existing annos in background.
+        """
+        deferred.defer(Anno.backfill_fingerprint)
         return message_types.VoidMessage()
 
 
@@ -7,10 +7,15 @@ import logging
 import base64
 
 import endpoints
+from google.appengine.api import oauth
 from google.appengine.api import search
 
 from model.user import User
+from api.session import get_session_user
 
+GEOCODER_TIMEOUT = 5  # seconds
+NO_COUNTRY_RESULT = ''  # google map answered, but the coordinate isn't in any country.
+BATCH_SIZE_LIMIT = 200  # max items of a batch insert request.
 
 def get_endpoints_current_user(raise_unauthorized=True):
     """Returns a current user and (optionally) causes an HTTP 401 if no user.
@@ -50,30 +55,42 @@ def handle_user(creator_id):
 
 
 def auth_user(headers):
-    current_user = get_endpoints_current_user(raise_unauthorized=False)
-    user = None
-    if current_user is None:
-        credential_pair = get_credential(headers)
-        email = credential_pair[0]
-        validate_email(email)
-        User.authenticate(credential_pair[0], md5(credential_pair[1]))
-        user = User.find_user_by_email(email)
-    else:
-        user = User.find_user_by_email(current_user.email())
+    user = get_user(headers)
     if user is None:
         raise endpoints.UnauthorizedException("No permission.")
     return user
 
 
+def auth_admin():
+    """
+    Check that the request is made by an administrator of the application with a google OAuth 2.0 token,
+    it guards moderation endpoints.
+    """
+    try:
+        is_admin = oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        raise endpoints.UnauthorizedException("No permission.")
+    if not is_admin:
+        raise endpoints.ForbiddenException("Administrator permission is required.")
+
+
 def get_user(headers):
+    """
+    Returns user of the request, a valid session token is checked first(see api.session), then the endpoints
+    current user and the credential in Authorization header.
+    """
+    user = get_session_user(headers)
+    if user is not None:
+        return user
     current_user = get_endpoints_current_user(raise_unauthorized=False)
-    user = None
     if current_user is None:
         credential_pair = get_credential(headers)
         email = credential_pair[0]
         validate_email(email)
-        User.authenticate(credential_pair[0], md5(credential_pair[1]))
         user = User.find_user_by_email(email)
+        # password is checked in memory, users without password(e.g. Google users) are not checked.
+        if user is not None and user.password is not None and user.password != md5(credential_pair[1]):
+            raise endpoints.UnauthorizedException("No permission.")
     else:
         user = User.find_user_by_email(current_user.email())
     return user
@@ -83,7 +100,8 @@ def get_country_by_coordinate(latitude, longitude):
     """
     This function returns country information by the specified coordinate.
     It sends request to google map by providing latitude&longitude and parse out country information from
-    the response.
+    the response. It's the fallback of api.geocoder.get_country, NO_COUNTRY_RESULT is returned if google map
+    has no country for the coordinate, None is returned if the request fails or times out.
 
     The country part of google map response is like:
     {
@@ -95,17 +113,27 @@ def get_country_by_coordinate(latitude, longitude):
     """
     map_url = "http://maps.googleapis.com/maps/api/geocode/json?latlng=" + str(latitude) + "," + str(
         longitude) + "&sensor=false"
-    conn = httplib.HTTPConnection("maps.googleapis.com")
-    conn.request('GET', map_url)
-    result = conn.getresponse()
-    content = result.read()
-    location_json = json.loads(content)
-    for address_component in location_json['results'][0]['address_components']:
-        logging.info("long_name:" + address_component['long_name'])
-        logging.info("short name:" + address_component['short_name'])
-        logging.info("types[0]:" + address_component['types'][0])
-        if address_component['types'][0] == 'country':
-            return address_component['long_name']
+    try:
+        conn = httplib.HTTPConnection("maps.googleapis.com", timeout=GEOCODER_TIMEOUT)
+        conn.request('GET', map_url)
+        result = conn.getresponse()
+        content = result.read()
+        location_json = json.loads(content)
+    except (httplib.HTTPException, IOError, ValueError):
+        logging.exception("Failed to retrieve country of (%s, %s) from google map." % (latitude, longitude))
+        return None
+    status = location_json.get('status')
+    if status == 'ZERO_RESULTS':
+        return NO_COUNTRY_RESULT
+    if status != 'OK':
+        logging.warning("Google map returned %s for (%s, %s)." % (status, latitude, longitude))
+        return None
+    results = location_json.get('results') or []
+    if len(results) > 0:
+        for address_component in results[0]['address_components']:
+            if address_component['types'][0] == 'country':
+                return address_component['long_name']
+    return NO_COUNTRY_RESULT
 
 
 def validate_email_address_format(email):
@@ -120,6 +148,13 @@ def validate_email(email):
         raise endpoints.BadRequestException("Email format is incorrect.")
 
 
+def validate_batch_size(items):
+    if len(items) == 0:
+        raise endpoints.BadRequestException("Batch is empty.")
+    if len(items) > BATCH_SIZE_LIMIT:
+        raise endpoints.BadRequestException("Batch size can't exceed %d." % BATCH_SIZE_LIMIT)
+
+
 def validate_password(password):
     if password is None or password == '':
         raise endpoints.BadRequestException("User password can't be empty.")
@@ -147,13 +182,13 @@ def get_credential(headers):
     return credential_pair
 
 
-def put_search_document(doc):
-    # index this document.
+def delete_search_documents(doc_ids):
+    # remove these documents from index.
     try:
         index = search.Index(name="anno_index")
-        index.put(doc)
+        index.delete(doc_ids)
     except search.Error:
-        logging.exception('Put document failed.')
+        logging.exception('Delete documents failed.')
 
 
 def delete_all_in_index(index_name):
@@ -1,7 +1,5 @@
 __author__ = 'topcircler'
 
-import datetime
-
 import endpoints
 from protorpc import message_types
 from protorpc import messages
@@ -11,11 +9,17 @@ from google.appengine.ext.db import BadValueError
 
 from message.vote_message import VoteMessage
 from message.vote_message import VoteListMessage
+from message.vote_message import VoteBatchMessage
+from message.vote_message import VoteBatchResultMessage
+from message.vote_message import VoteBatchResponseMessage
 from api.utils import anno_js_client_id
 from api.utils import auth_user
-from api.utils import put_search_document
+from api.keyed_batch import batch_insert
 from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
 from model.vote import Vote
+from model.user_app_set import UserAppSet
+from model.user_anno_activity import UserAnnoActivity
 
 
 @endpoints.api(name='vote', version='1.0', description='Vote API',
@@ -36,24 +40,30 @@ class VoteApi(remote.Service):
         if anno is None:
             raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % request.id)
 
-        vote = Vote()
-        vote.anno_key = anno.key
-        vote.creator = user.key
-        if request.created is not None:
-            vote.created = request.created
-        vote.put()
-
-        anno.vote_count += 1
-        anno.last_update_time = datetime.datetime.now()
-        anno.last_activity = 'vote'
-        anno.last_update_type = 'create'
-        anno.put()
+        # a user can vote an anno only once, inserting again returns the existing vote.
+        vote, inserted = Vote.insert(anno.key, user.key, request.created)
+        if not inserted:
+            return vote.to_message()
 
-        # update vote in search document
-        put_search_document(anno.generate_search_document())
+        # vote count, last activity and search document are rolled up into anno by the counter.
+        AnnoCounterShard.increment(anno, 'vote_count')
+        UserAppSet.add_app_name(user.key, anno.app_name)
+        UserAnnoActivity.record(user.key, anno.key, 'vote', vote.created)
 
         return vote.to_message()
 
+
+    @endpoints.method(VoteBatchMessage, VoteBatchResponseMessage, path='vote/batch', http_method='POST',
+                      name='vote.batch_insert')
+    def vote_batch_insert(self, request):
+        """
+        Exposes an API endpoint to insert a batch of votes for the current user.
+        Results are returned per item in request order, voting an anno twice returns the existing vote.
+        """
+        user = auth_user(self.request_state.headers)
+        results = batch_insert(Vote, request.vote_list, user, VoteBatchResultMessage, 'vote')
+        return VoteBatchResponseMessage(result_list=results)
+
     vote_with_id_resource_container = endpoints.ResourceContainer(
         message_types.VoidMessage,
         anno_id=messages.IntegerField(2),
@@ -71,20 +81,22 @@ class VoteApi(remote.Service):
         if request.id is None and request.anno_id is None:
             raise endpoints.BadRequestException('id or anno_id field is required.')
         if request.id is not None:
-            vote = Vote.get_by_id(request.id)
+            vote = Vote.get_by_message_id(request.id, user)
             if vote is None:
                 raise endpoints.NotFoundException('No vote entity with the id "%s" exists.' % request.id)
             anno = vote.anno_key.get()
-            vote.key.delete()
-            anno.vote_count -= 1
-            anno.put()
+            deleted = Vote.delete_by_user(vote.anno_key, vote.creator)
+            if deleted > 0:
+                AnnoCounterShard.increment(anno, 'vote_count', -deleted)
+                UserAnnoActivity.remove(vote.creator, vote.anno_key, 'vote')
         elif request.anno_id is not None:
             anno = Anno.get_by_id(request.anno_id)
-            for key in Vote.query(Vote.anno_key == anno.key, Vote.creator == user.key).iter(keys_only=True):
-                key.delete()
-                anno.vote_count -= 1
-                anno.put()
-        put_search_document(anno.generate_search_document())
+            if anno is None:
+                raise endpoints.NotFoundException('No anno entity with the id "%s" exists.' % request.anno_id)
+            deleted = Vote.delete_by_user(anno.key, user.key)
+            if deleted > 0:
+                AnnoCounterShard.increment(anno, 'vote_count', -deleted)
+                UserAnnoActivity.remove(user.key, anno.key, 'vote')
         return message_types.VoidMessage()
 
     @endpoints.method(vote_with_id_resource_container, VoteMessage, http_method='GET', path='vote/{id}',
@@ -96,7 +108,7 @@ class VoteApi(remote.Service):
         user = auth_user(self.request_state.headers)
         if request.id is None:
             raise endpoints.BadRequestException('id field is required.')
-        vote = Vote.get_by_id(request.id)
+        vote = Vote.get_by_message_id(request.id, user)
         if vote is None:
             raise endpoints.NotFoundException('No vote entity with the id "%s" exists.' % request.id)
         return vote.to_message()
@@ -129,7 +141,8 @@ class VoteApi(remote.Service):
         else:
             votes, next_curs, more = Vote.query().fetch_page(limit)
 
-        items = [entity.to_message() for entity in votes]
+        creators = Vote.resolve_creators(votes)
+        items = [entity.to_message(creators) for entity in votes]
         if more:
             return VoteListMessage(vote_list=items, cursor=next_curs.urlsafe(), has_more=more)
         else:
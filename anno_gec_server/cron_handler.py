@@ -0,0 +1,14 @@
+__author__ = 'topcircler'
+
+import webapp2
+from google.appengine.ext import deferred
+
+from model.anno_children import sweep_orphans
+
+
+class SweepOrphansHandler(webapp2.RequestHandler):
+    def get(self):
+        """
+        handle cron request to delete children of deleted annos, see cron.yaml.
+        """
+        deferred.defer(sweep_orphans)
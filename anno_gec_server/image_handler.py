@@ -18,12 +18,15 @@ class ImageHandler(webapp2.RequestHandler):
             self.response.out.write(u'anno_id parameter is required.')
         else:
             anno = Anno.get_by_id(long(anno_id))
+            image = None
+            if anno is not None:
+                image = anno.get_image()
             if anno is None:
                 self.response.set_status(400)
                 self.response.out.write('No anno entity with the id "%s" exists.' % anno_id)
-            elif anno.image is None:
+            elif image is None:
                 self.response.set_status(404)
                 self.response.out.write("This anno doesn't contain screenshot")
             else:
                 self.response.headers['Content-Type'] = 'image/png'
-                self.response.out.write(anno.image)
+                self.response.out.write(image)
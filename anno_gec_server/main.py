@@ -3,6 +3,8 @@ __author__ = 'topcircler'
 import webapp2
 
 from image_handler import ImageHandler
+from cron_handler import SweepOrphansHandler
 
 
-application = webapp2.WSGIApplication([('/screenshot', ImageHandler)], debug=True)
\ No newline at end of file
+application = webapp2.WSGIApplication([('/screenshot', ImageHandler),
+                                       ('/cron/sweep_orphans', SweepOrphansHandler)], debug=True)
\ No newline at end of file
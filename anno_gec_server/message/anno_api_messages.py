@@ -98,6 +98,7 @@ class AnnoResponseMessage(messages.Message):
     longitude = messages.FloatField(30)
     country = messages.StringField(31)
     last_update_type = messages.StringField(32)
+    followup_cursor = messages.StringField(33)  # cursor of the next page of followup_list, see followup.list.
 
 
 class AnnoListMessage(messages.Message):
@@ -107,4 +108,26 @@ class AnnoListMessage(messages.Message):
     anno_list = messages.MessageField(AnnoResponseMessage, 1, repeated=True)
     cursor = messages.StringField(2)
     has_more = messages.BooleanField(3)
-    offset = messages.IntegerField(4)
\ No newline at end of file
+    offset = messages.IntegerField(4)
+
+
+class AnnoBatchMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent a batch of annos to insert.
+    """
+    anno_list = messages.MessageField(AnnoMessage, 1, repeated=True)
+
+
+class AnnoBatchResultMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent result of one item of an anno batch, error is set if the item failed.
+    """
+    anno = messages.MessageField(AnnoResponseMessage, 1)
+    error = messages.StringField(2)
+
+
+class AnnoBatchResponseMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent results of an anno batch, in the same order as the batch items.
+    """
+    result_list = messages.MessageField(AnnoBatchResultMessage, 1, repeated=True)
\ No newline at end of file
@@ -0,0 +1,12 @@
+__author__ = 'topcircler'
+
+from protorpc import messages
+
+
+class AnnoCacheStatsMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent hit rate of anno detail cache.
+    """
+    hits = messages.IntegerField(1)
+    misses = messages.IntegerField(2)
+    hit_rate = messages.FloatField(3)
@@ -0,0 +1,23 @@
+__author__ = 'topcircler'
+
+from protorpc import messages
+from protorpc import message_types
+
+
+class CounterReconcileStatsMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent drift statistics of anno counter reconciliation.
+    finished_time is empty while reconciliation is running.
+    """
+    checked = messages.IntegerField(1)
+    changed = messages.IntegerField(2)
+    max_drift = messages.IntegerField(3)
+    vote_count_mismatches = messages.IntegerField(4)
+    vote_count_drift = messages.IntegerField(5)
+    flag_count_mismatches = messages.IntegerField(6)
+    flag_count_drift = messages.IntegerField(7)
+    followup_count_mismatches = messages.IntegerField(8)
+    followup_count_drift = messages.IntegerField(9)
+    started_time = message_types.DateTimeField(10)
+    finished_time = message_types.DateTimeField(11)
+    skipped = messages.IntegerField(12)  # annos with recent increments, they are checked by the next run.
@@ -22,4 +22,26 @@ class FlagListMessage(messages.Message):
     """
     flag_list = messages.MessageField(FlagMessage, 1, repeated=True)
     cursor = messages.StringField(2)
-    has_more = messages.BooleanField(3)
\ No newline at end of file
+    has_more = messages.BooleanField(3)
+
+
+class FlagBatchMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent a batch of flags to insert.
+    """
+    flag_list = messages.MessageField(FlagMessage, 1, repeated=True)
+
+
+class FlagBatchResultMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent result of one item of a flag batch, error is set if the item failed.
+    """
+    flag = messages.MessageField(FlagMessage, 1)
+    error = messages.StringField(2)
+
+
+class FlagBatchResponseMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent results of a flag batch, in the same order as the batch items.
+    """
+    result_list = messages.MessageField(FlagBatchResultMessage, 1, repeated=True)
\ No newline at end of file
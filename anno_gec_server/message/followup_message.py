@@ -23,4 +23,26 @@ class FollowupListMessage(messages.Message):
     """
     followup_list = messages.MessageField(FollowupMessage, 1, repeated=True)
     cursor = messages.StringField(2)
-    has_more = messages.BooleanField(3)
\ No newline at end of file
+    has_more = messages.BooleanField(3)
+
+
+class FollowupBatchMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent a batch of followups to insert.
+    """
+    followup_list = messages.MessageField(FollowupMessage, 1, repeated=True)
+
+
+class FollowupBatchResultMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent result of one item of a followup batch, error is set if the item failed.
+    """
+    followup = messages.MessageField(FollowupMessage, 1)
+    error = messages.StringField(2)
+
+
+class FollowupBatchResponseMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent results of a followup batch, in the same order as the batch items.
+    """
+    result_list = messages.MessageField(FollowupBatchResultMessage, 1, repeated=True)
\ No newline at end of file
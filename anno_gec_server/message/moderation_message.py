@@ -0,0 +1,10 @@
+__author__ = 'topcircler'
+
+from protorpc import messages
+
+
+class BulkDeleteResultMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent result of a bulk moderation delete.
+    """
+    deleted_count = messages.IntegerField(1)
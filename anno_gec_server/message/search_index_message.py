@@ -0,0 +1,20 @@
+__author__ = 'topcircler'
+
+from protorpc import messages
+from protorpc import message_types
+
+
+class SearchIndexStatsMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent metrics of the coalescing search index updater.
+    """
+    marked = messages.IntegerField(1)
+    flushes = messages.IntegerField(2)
+    flushed_marks = messages.IntegerField(3)
+    flushed_documents = messages.IntegerField(4)
+    last_batch_size = messages.IntegerField(5)
+    last_lag_ms = messages.IntegerField(6)
+    max_lag_ms = messages.IntegerField(7)
+    average_lag_ms = messages.IntegerField(8)
+    last_flush_time = message_types.DateTimeField(9)
+    pending_marks = messages.IntegerField(10)
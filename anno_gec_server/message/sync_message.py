@@ -0,0 +1,36 @@
+__author__ = 'topcircler'
+
+from protorpc import messages
+from protorpc import message_types
+
+from message.anno_api_messages import AnnoResponseMessage
+from message.vote_message import VoteMessage
+from message.flag_message import FlagMessage
+from message.followup_message import FollowupMessage
+
+
+class ChangeMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent the latest change of an entity.
+    Entity content is set for created/updated entities according to kind, deleted entities only have identity.
+    """
+    kind = messages.StringField(1)  # 'anno', 'vote', 'flag' or 'followup'.
+    key = messages.StringField(2)  # urlsafe key of the entity, it identifies the entity across kinds.
+    id = messages.IntegerField(3)
+    anno_id = messages.IntegerField(4)
+    version = messages.IntegerField(5)  # increases on every change of the entity.
+    deleted = messages.BooleanField(6)
+    updated = message_types.DateTimeField(7)
+    anno = messages.MessageField(AnnoResponseMessage, 8)  # screenshot isn't included, see /screenshot.
+    vote = messages.MessageField(VoteMessage, 9)
+    flag = messages.MessageField(FlagMessage, 10)
+    followup = messages.MessageField(FollowupMessage, 11)
+
+
+class ChangeListMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent a page of changes.
+    """
+    change_list = messages.MessageField(ChangeMessage, 1, repeated=True)
+    token = messages.StringField(2)  # pass it as since of the next call.
+    has_more = messages.BooleanField(3)
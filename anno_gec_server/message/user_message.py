@@ -8,4 +8,6 @@ class UserMessage(messages.Message):
     user_email = messages.StringField(2)
     display_name = messages.StringField(3)
     password = messages.StringField(4)
-    auth_source = messages.StringField(5)
\ No newline at end of file
+    auth_source = messages.StringField(5)
+    session_token = messages.StringField(6)  # set by account.authenticate, send it in X-Anno-Session header.
+    session_expires = messages.IntegerField(7)  # expiry time of session_token in seconds since epoch.
\ No newline at end of file
@@ -22,4 +22,26 @@ class VoteListMessage(messages.Message):
     """
     vote_list = messages.MessageField(VoteMessage, 1, repeated=True)
     cursor = messages.StringField(2)
-    has_more = messages.BooleanField(3)
\ No newline at end of file
+    has_more = messages.BooleanField(3)
+
+
+class VoteBatchMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent a batch of votes to insert.
+    """
+    vote_list = messages.MessageField(VoteMessage, 1, repeated=True)
+
+
+class VoteBatchResultMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent result of one item of a vote batch, error is set if the item failed.
+    """
+    vote = messages.MessageField(VoteMessage, 1)
+    error = messages.StringField(2)
+
+
+class VoteBatchResponseMessage(messages.Message):
+    """
+    ProtoRPC message definition to represent results of a vote batch, in the same order as the batch items.
+    """
+    result_list = messages.MessageField(VoteBatchResultMessage, 1, repeated=True)
\ No newline at end of file
@@ -5,17 +5,29 @@ Anno data store model definition.
 """
 
 import datetime
+import hashlib
 import logging
 
+import endpoints
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+from protorpc.messages import ValidationError
 
 from message.anno_api_messages import AnnoResponseMessage
 from message.anno_api_messages import AnnoListMessage
+from message.user_message import UserMessage
 from model.base_model import BaseModel
-from api.utils import get_country_by_coordinate
+from model.screenshot import Screenshot
+from model.anno_fingerprint import AnnoFingerprint
+from api.geocoder import get_country
 from api.utils import tokenize_string
 from api.utils import is_empty_string
+from api.utils import delete_search_documents
+from api.search_index import mark_search_document_dirty
+from api.search_index import mark_search_documents_dirty
 
 
 class Anno(BaseModel):
@@ -25,7 +37,8 @@ class Anno(BaseModel):
     anno_text = ndb.StringProperty(required=True)
     simple_x = ndb.FloatProperty(required=True)
     simple_y = ndb.FloatProperty(required=True)
-    image = ndb.BlobProperty()
+    image = ndb.BlobProperty()  # legacy screenshot storage, moved into Screenshot by migrate_screenshot.
+    screenshot_key = ndb.KeyProperty(kind=Screenshot)
     anno_type = ndb.StringProperty(required=True, default='simple_comment')
     simple_circle_on_top = ndb.BooleanProperty(required=True)
     simple_is_moved = ndb.BooleanProperty(required=True)
@@ -44,12 +57,24 @@ class Anno(BaseModel):
     flag_count = ndb.IntegerProperty(default=0)  # how many flags are there for this anno
     vote_count = ndb.IntegerProperty(default=0)  # how many votes are there for this anno
     followup_count = ndb.IntegerProperty(default=0)  # how many follow ups are there for this anno
+    activity_count = ndb.IntegerProperty(default=0)  # vote_count + flag_count + followup_count
     last_update_time = ndb.DateTimeProperty(auto_now_add=True)  # last time that vote/flag/followup creation.
     last_activity = ndb.StringProperty('anno')  # last activity, vote/flag/followup creation
     last_update_type = ndb.StringProperty(default='create')  # create/edit
     latitude = ndb.FloatProperty()
     longitude = ndb.FloatProperty()
     country = ndb.StringProperty()
+    fingerprint = ndb.StringProperty()  # identifies duplicate annos, see compute_fingerprint.
+    enrichment_pending = ndb.BooleanProperty(default=False)  # whether post-insert pipeline hasn't finished yet.
+
+    ENRICHMENT_QUEUE = 'anno-enrichment'
+    PUT_UNIQUE_CHUNK_SIZE = 12  # annos of one put_unique_multi, each anno and its fingerprint are 2 of 25 xg groups.
+
+    # fields which are returned from search documents when search results are served from index only.
+    SEARCH_RESPONSE_FIELDS = ['anno_text', 'app_name', 'anno_type', 'simple_x', 'simple_y', 'simple_circle_on_top',
+                              'level', 'app_version', 'device_model', 'os_name', 'os_version', 'country',
+                              'vote_count', 'flag_count', 'followup_count', 'activity_count', 'created',
+                              'last_update_time', 'last_activity', 'creator_id', 'creator_display_name']
 
     def __eq__(self, other):
         return self.key.id() == other.key.id()
@@ -57,13 +82,20 @@ class Anno(BaseModel):
     def __hash__(self):
         return hash(self.key.id())
 
-    def to_response_message(self):
+    def get_change_anno_id(self):
+        return self.key.id()
+
+    @classmethod
+    def get_deleted_anno_id(cls, key):
+        return key.id()
+
+    def to_response_message(self, creators=None):
         """
         Convert anno model to AnnoResponseMessage.
+
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
-        user_message = None
-        if self.creator is not None:
-            user_message = self.creator.get().to_message()
+        user_message = self.get_creator_message(creators)
         return AnnoResponseMessage(id=self.key.id(),
                                    anno_text=self.anno_text,
                                    simple_x=self.simple_x,
@@ -87,27 +119,95 @@ class Anno(BaseModel):
                                    vote_count=self.vote_count,
                                    flag_count=self.flag_count,
                                    followup_count=self.followup_count,
+                                   activity_count=self.activity_count,
                                    last_update_time=self.last_update_time,
                                    last_activity=self.last_activity,
                                    last_update_type=self.last_update_type
         )
 
-    def to_response_message_by_projection(self, projection):
+    def to_response_message_by_projection(self, projection, creators=None):
         """
         convert anno model to AnnoResponseMessage by projection.
+
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
         anno_resp_message = AnnoResponseMessage(id=self.key.id())
         for prop_name in projection:
             if prop_name == 'creator':
-                anno_resp_message.creator = self.creator.get().to_message()
+                anno_resp_message.creator = self.get_creator_message(creators)
             else:
                 anno_resp_message.__setattr__(prop_name, getattr(self, prop_name))
         return anno_resp_message
 
     @classmethod
-    def insert_anno(cls, message, user):
+    def get_cache_generation_key(cls, anno_id):
+        return "anno_generation:%d" % anno_id
+
+    @classmethod
+    def invalidate_cache(cls, anno_id):
         """
-        create a new anno model from request message.
+        Invalidate cached anno detail by bumping its cache generation, see api.anno_cache.
+        """
+        memcache.incr(cls.get_cache_generation_key(anno_id))
+
+    def compute_activity_count(self):
+        """
+        Compute activity count from vote/flag/followup counts.
+        """
+        return (self.vote_count or 0) + (self.flag_count or 0) + (self.followup_count or 0)
+
+    def compute_fingerprint(self):
+        """
+        Compute a deterministic fingerprint from the fields which identify a duplicate anno, plus creator.
+        """
+        values = [self.app_name, self.anno_text, self.anno_type, self.app_version, self.level, self.os_name,
+                  self.os_version, self.device_model, self.screenshot_is_anonymized, self.created,
+                  self.simple_circle_on_top, self.simple_x, self.simple_y, self.simple_is_moved,
+                  self.creator.id() if self.creator is not None else None]
+        parts = []
+        for value in values:
+            if value is None:
+                parts.append(u'')
+            elif isinstance(value, float):
+                parts.append(repr(value).decode('ascii'))
+            elif isinstance(value, datetime.datetime):
+                parts.append(value.isoformat().decode('ascii'))
+            else:
+                parts.append(unicode(value))
+        return hashlib.sha1(u'\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def set_image(self, image):
+        """
+        Store screenshot into Screenshot, current anno only keeps the reference.
+        """
+        self.screenshot_key = Screenshot.save_image(image)
+        self.image = None
+
+    def get_image(self):
+        """
+        Get screenshot content of current anno, legacy screenshot is returned if it's not migrated yet.
+        """
+        if self.screenshot_key is not None:
+            screenshot = self.screenshot_key.get()
+            if screenshot is not None:
+                return screenshot.image
+        return self.image
+
+    @classmethod
+    def to_response_messages(cls, annos, projection=None):
+        """
+        Convert a page of annos to AnnoResponseMessage list, creators of the page are resolved in one batch.
+        """
+        if projection is not None:
+            creators = cls.resolve_creators(annos) if 'creator' in projection else {}
+            return [anno.to_response_message_by_projection(projection, creators) for anno in annos]
+        creators = cls.resolve_creators(annos)
+        return [anno.to_response_message(creators) for anno in annos]
+
+    @classmethod
+    def from_message(cls, message, user):
+        """
+        create a new anno model from request message, it's not saved.
         """
         entity = cls(anno_text=message.anno_text, simple_x=message.simple_x, simple_y=message.simple_y,
                      anno_type=message.anno_type,
@@ -117,28 +217,215 @@ class Anno(BaseModel):
                      os_name=message.os_name, os_version=message.os_version, creator=user.key,
                      draw_elements=message.draw_elements, screenshot_is_anonymized=message.screenshot_is_anonymized,
                      geo_position=message.geo_position, flag_count=0, vote_count=0, followup_count=0,
+                     activity_count=0,
                      last_activity='UserSource', latitude=message.latitude, longitude=message.longitude)
-        # set image.
-        entity.image = message.image
-        # set created time if provided in the message.
+        # set created time if provided in the message, otherwise it's now.
         if message.created is not None:
             entity.created = message.created
-            # use google map api to retrieve country information and save into datastore.
-        if message.latitude is not None and message.longitude is not None:
-            entity.country = get_country_by_coordinate(message.latitude, message.longitude)
-            # set last update time & activity
-        entity.last_update_time = datetime.datetime.now()
-        entity.last_activity = 'UserSource'
-        entity.last_update_type = 'create'
-        entity.put()
+        else:
+            entity.created = datetime.datetime.now()
+        entity.fingerprint = entity.compute_fingerprint()
         return entity
 
+    @classmethod
+    def insert_anno(cls, message, user):
+        """
+        create a new anno model from request message.
+
+        Anno fingerprint is claimed in the same transaction, so a concurrent duplicate insert fails.
+        Country lookup and search indexing are done by the post-insert pipeline(see enrich).
+        """
+        entity = cls.from_message(message, user)
+        # set image.
+        if message.image is not None:
+            entity.set_image(message.image)
+        entity.init_new_anno()
+        exist_anno_key = cls.put_unique(entity)
+        if exist_anno_key is not None:
+            raise endpoints.BadRequestException("Duplicate anno(%s) already exists." % exist_anno_key.id())
+        return entity
+
+    @classmethod
+    def insert_annos(cls, anno_messages, user):
+        """
+        Batch version of insert_anno.
+
+        Screenshots of the batch are written by one put_multi, annos are saved and their fingerprints claimed
+        by put_unique_multi, chunk by chunk, so a concurrent duplicate insert fails like in insert_anno.
+        Returns a list of (anno, error) in the same order as anno_messages, anno is None if the item failed.
+        """
+        results = [(None, None)] * len(anno_messages)
+        candidates = []
+        batch_fingerprints = {}
+        for index, message in enumerate(anno_messages):
+            try:
+                message.check_initialized()
+            except ValidationError as e:
+                results[index] = (None, str(e))
+                continue
+            entity = cls.from_message(message, user)
+            if entity.fingerprint in batch_fingerprints:
+                results[index] = (None, "Duplicate of item %d in this batch." % batch_fingerprints[entity.fingerprint])
+                continue
+            batch_fingerprints[entity.fingerprint] = index
+            candidates.append((index, entity, message.image))
+        if len(candidates) == 0:
+            return results
+
+        Screenshot.save_images([image for _, _, image in candidates if image is not None])
+        for index, entity, image in candidates:
+            if image is not None:
+                entity.screenshot_key = Screenshot.get_key(image)
+            entity.init_new_anno()
+        for start in range(0, len(candidates), cls.PUT_UNIQUE_CHUNK_SIZE):
+            chunk = candidates[start:start + cls.PUT_UNIQUE_CHUNK_SIZE]
+            exist_anno_keys = cls.put_unique_multi([entity for _, entity, _ in chunk])
+            for (index, entity, _), exist_anno_key in zip(chunk, exist_anno_keys):
+                if exist_anno_key is not None:
+                    results[index] = (None, "Duplicate anno(%s) already exists." % exist_anno_key.id())
+                else:
+                    results[index] = (entity, None)
+        return results
+
+    def init_new_anno(self):
+        """
+        Initialize last update and post-insert pipeline fields of a new anno.
+        """
+        self.enrichment_pending = True
+        # set last update time & activity
+        self.last_update_time = datetime.datetime.now()
+        self.last_activity = 'UserSource'
+        self.last_update_type = 'create'
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def put_unique(cls, entity):
+        """
+        Save the given new anno and claim its fingerprint, post-insert pipeline is enqueued in the same transaction.
+        Returns key of the anno which already owns the fingerprint, None if the anno is saved.
+        """
+        return cls.put_unique_multi([entity])[0]
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def put_unique_multi(cls, entities):
+        """
+        Batch version of put_unique, at most PUT_UNIQUE_CHUNK_SIZE annos with distinct fingerprints.
+        The enrichment of the saved annos is enqueued as one task in the same transaction.
+        Returns a list of the keys of annos which already own the fingerprints, in the same order as entities.
+        """
+        fingerprint_keys = [ndb.Key(AnnoFingerprint, entity.fingerprint) for entity in entities]
+        exist_anno_keys = [anno_fingerprint.anno_key if anno_fingerprint is not None else None
+                           for anno_fingerprint in ndb.get_multi(fingerprint_keys)]
+        new_entities = [entity for entity, exist_anno_key in zip(entities, exist_anno_keys) if exist_anno_key is None]
+        ndb.put_multi(new_entities)
+        ndb.put_multi([AnnoFingerprint(key=fingerprint_key, anno_key=entity.key)
+                       for entity, fingerprint_key, exist_anno_key in zip(entities, fingerprint_keys, exist_anno_keys)
+                       if exist_anno_key is None])
+        pending_ids = [entity.key.id() for entity in new_entities if entity.enrichment_pending]
+        if len(pending_ids) == 1:
+            deferred.defer(cls.enrich, pending_ids[0], _queue=cls.ENRICHMENT_QUEUE, _transactional=True)
+        elif len(pending_ids) > 1:
+            deferred.defer(cls.enrich_multi, pending_ids, _queue=cls.ENRICHMENT_QUEUE, _transactional=True)
+        return exist_anno_keys
+
+    @ndb.transactional(xg=True)
+    def put_merged(self):
+        """
+        Save current anno after a merge. If a fingerprinted field changed, the old fingerprint is released
+        and the new one is claimed in the same transaction.
+        Returns key of another anno which already owns the new fingerprint, None if the anno is saved.
+        """
+        # fingerprint is read from the saved anno, so a retried transaction still releases the old one.
+        saved_anno = self.key.get()
+        old_fingerprint = saved_anno.fingerprint if saved_anno is not None else None
+        new_fingerprint = self.compute_fingerprint()
+        if new_fingerprint != old_fingerprint:
+            new_key = ndb.Key(AnnoFingerprint, new_fingerprint)
+            anno_fingerprint = new_key.get()
+            if anno_fingerprint is not None and anno_fingerprint.anno_key != self.key:
+                return anno_fingerprint.anno_key
+            if old_fingerprint is not None:
+                old_key = ndb.Key(AnnoFingerprint, old_fingerprint)
+                old_anno_fingerprint = old_key.get()
+                if old_anno_fingerprint is not None and old_anno_fingerprint.anno_key == self.key:
+                    old_key.delete()
+            AnnoFingerprint(key=new_key, anno_key=self.key).put()
+            self.fingerprint = new_fingerprint
+        self.put()
+        return None
+
+    @classmethod
+    def enrich(cls, anno_id):
+        """
+        Post-insert pipeline of an anno, it runs in push queue: look up country, mark search document dirty
+        and clear enrichment_pending. It's idempotent, a failed run is retried by task queue.
+        """
+        anno = cls.get_by_id(anno_id)
+        if anno is None or not anno.enrichment_pending:
+            return
+        if anno.country is None and anno.latitude is not None and anno.longitude is not None:
+            anno.country = get_country(anno.latitude, anno.longitude)
+        # marked before enrichment_pending is cleared, so the retry of a failed mark still finds the anno pending.
+        # the flush runs api.search_index.FLUSH_DELAY later and reads the enriched anno.
+        mark_search_document_dirty(anno_id)
+        cls._finish_enrichment(anno.key, anno.country)
+        cls.invalidate_cache(anno_id)
+
+    @classmethod
+    def enrich_multi(cls, anno_ids):
+        """
+        Batch version of enrich, search documents of the batch are flushed together.
+        """
+        annos = ndb.get_multi([ndb.Key(cls, anno_id) for anno_id in anno_ids])
+        annos = [anno for anno in annos if anno is not None and anno.enrichment_pending]
+        for anno in annos:
+            if anno.country is None and anno.latitude is not None and anno.longitude is not None:
+                anno.country = get_country(anno.latitude, anno.longitude)
+        mark_search_documents_dirty([anno.key.id() for anno in annos])
+        futures = [cls._finish_enrichment_async(anno.key, anno.country) for anno in annos]
+        for future in futures:
+            future.get_result()
+
+    @classmethod
+    def _finish_enrichment(cls, anno_key, country):
+        cls._finish_enrichment_async(anno_key, country).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _finish_enrichment_async(cls, anno_key, country):
+        anno = yield anno_key.get_async()
+        if anno is not None and anno.enrichment_pending:
+            anno.country = country
+            anno.enrichment_pending = False
+            yield anno.put_async()
+
     @classmethod
     def delete(cls, anno):
+        """
+        Delete an anno and its search document, votes, flags, followups and other children are deleted
+        in background, see model.anno_children.
+        """
+        # imported here since model.anno_children imports this module.
+        from model.anno_children import delete_anno_children
+
         anno_id = "%d" % anno.key.id()
-        anno.key.delete()
+        cls.delete_multi([anno.key])
+        if anno.fingerprint is not None:
+            cls._release_fingerprint(anno.key, anno.fingerprint)
         index = search.Index(name="anno_index")
         index.delete(anno_id)
+        cls.invalidate_cache(anno.key.id())
+        deferred.defer(delete_anno_children, anno.key.id())
+
+    @classmethod
+    @ndb.transactional
+    def _release_fingerprint(cls, anno_key, fingerprint):
+        # a duplicate anno carries the fingerprint of the anno which owns it, only the owner releases it.
+        fingerprint_key = ndb.Key(AnnoFingerprint, fingerprint)
+        anno_fingerprint = fingerprint_key.get()
+        if anno_fingerprint is not None and anno_fingerprint.anno_key == anno_key:
+            fingerprint_key.delete()
 
     def merge_from_message(self, message):
         """
@@ -153,7 +440,7 @@ class Anno(BaseModel):
         if message.simple_y is not None:
             self.simple_y = message.simple_y
         if message.image is not None:
-            self.image = message.image
+            self.set_image(message.image)
         if message.anno_type is not None:
             self.anno_type = message.anno_type
         if message.simple_circle_on_top is not None:
@@ -181,22 +468,16 @@ class Anno(BaseModel):
             # TODO: can't merge latitude & longitude now, if to enable it, also needs to look up country again.
 
     @classmethod
-    def query_by_app_by_created(cls, app_name, limit, projection, curs):
-        query = cls.query()
-        query = query.filter(cls.app_name == app_name)
-        query = query.order(-cls.created)
-        if (curs is not None) and (projection is not None):
-            annos, next_curs, more = query.fetch_page(limit, start_cursor=curs, projection=projection)
-        elif (curs is not None) and (projection is None):
-            annos, next_curs, more = query.fetch_page(limit, start_cursor=curs)
-        elif (curs is None) and (projection is not None):
-            annos, next_curs, more = query.fetch_page(limit, projection=projection)
-        else:
-            annos, next_curs, more = query.fetch_page(limit)
-        if projection is not None:
-            items = [entity.to_response_message_by_projection(projection) for entity in annos]
-        else:
-            items = [entity.to_response_message() for entity in annos]
+    def query_page(cls, query, limit, projection, curs):
+        """
+        This method fetches one page of the given anno query, it's shared by all paginated anno list queries.
+        :param query: anno query with filters and orders applied.
+        :param limit: page size.
+        :param projection: property names to select, None means all properties.
+        :param curs: start cursor, None means the first page.
+        """
+        annos, next_curs, more = query.fetch_page(limit, start_cursor=curs, projection=projection)
+        items = cls.to_response_messages(annos, projection)
 
         if more:
             return AnnoListMessage(anno_list=items, cursor=next_curs.urlsafe(), has_more=more)
@@ -204,117 +485,65 @@ class Anno(BaseModel):
             return AnnoListMessage(anno_list=items, has_more=more)
 
     @classmethod
-    def query_by_vote_count(cls, app_name):
+    def query_by_app_by_created(cls, app_name, limit, projection, curs):
+        query = cls.query().filter(cls.app_name == app_name).order(-cls.created)
+        return cls.query_page(query, limit, projection, curs)
+
+    @classmethod
+    def query_by_vote_count(cls, app_name, limit, projection, curs):
         query = cls.query().filter(cls.app_name == app_name).order(-cls.vote_count)
-        anno_list = []
-        for anno in query:
-            anno_message = anno.to_response_message()
-            anno_message.vote_count = anno.vote_count
-            anno_list.append(anno_message)
-        return AnnoListMessage(anno_list=anno_list)
+        return cls.query_page(query, limit, projection, curs)
 
     @classmethod
-    def query_by_flag_count(cls, app_name):
+    def query_by_flag_count(cls, app_name, limit, projection, curs):
         query = cls.query().filter(cls.app_name == app_name).filter(cls.flag_count > 0).order(-cls.flag_count)
-        anno_list = []
-        for anno in query:
-            anno_message = anno.to_response_message()
-            anno_message.flag_count = anno.flag_count
-            anno_list.append(anno_message)
-        return AnnoListMessage(anno_list=anno_list)
+        return cls.query_page(query, limit, projection, curs)
 
     @classmethod
-    def query_by_activity_count(cls, app_name):
-        anno_list = []
-        for anno in cls.query().filter(cls.app_name == app_name):
-            anno_list.append(anno)
-        anno_list = sorted(anno_list, key=lambda x: (x.vote_count + x.flag_count + x.followup_count), reverse=True)
-        anno_resp_list = []
-        for anno in anno_list:
-            anno_message = anno.to_response_message()
-            anno_message.activity_count = anno.vote_count + anno.flag_count + anno.followup_count
-            anno_resp_list.append(anno_message)
-        return AnnoListMessage(anno_list=anno_resp_list)
-
-    @classmethod
-    def query_by_last_activity(cls, app_name):
+    def query_by_activity_count(cls, app_name, limit, projection, curs):
+        query = cls.query().filter(cls.app_name == app_name).order(-cls.activity_count)
+        return cls.query_page(query, limit, projection, curs)
+
+    @classmethod
+    def query_by_last_activity(cls, app_name, limit, projection, curs):
         query = cls.query().filter(cls.app_name == app_name).order(-cls.last_update_time)
-        anno_list = []
-        for anno in query:
-            anno_message = anno.to_response_message()
-            anno_message.last_update_time = anno.last_update_time
-            anno_message.last_activity = anno.last_activity
-            anno_list.append(anno_message)
-        return AnnoListMessage(anno_list=anno_list)
+        return cls.query_page(query, limit, projection, curs)
 
     @classmethod
-    def query_by_country(cls, app_name):
+    def query_by_country(cls, app_name, limit, projection, curs):
         """
         Query annos for a given app by country alphabetical order.
-        No pagination is supported here.
         """
         query = cls.query().filter(cls.app_name == app_name).order(cls.country)
-        anno_list = []
-        for anno in query:
-            anno_message = anno.to_response_message()
-            anno_list.append(anno_message)
-        return AnnoListMessage(anno_list=anno_list)
+        return cls.query_page(query, limit, projection, curs)
 
     @classmethod
     def query_by_page(cls, limit, projection, curs):
         query = cls.query().order(-cls.created)
-        if (curs is not None) and (projection is not None):
-            annos, next_curs, more = query.fetch_page(limit, start_cursor=curs, projection=projection)
-        elif (curs is not None) and (projection is None):
-            annos, next_curs, more = query.fetch_page(limit, start_cursor=curs)
-        elif (curs is None) and (projection is not None):
-            annos, next_curs, more = query.fetch_page(limit, projection=projection)
-        else:
-            annos, next_curs, more = query.fetch_page(limit)
-        if projection is not None:
-            items = [entity.to_response_message_by_projection(projection) for entity in annos]
-        else:
-            items = [entity.to_response_message() for entity in annos]
-
-        if more:
-            return AnnoListMessage(anno_list=items, cursor=next_curs.urlsafe(), has_more=more)
-        else:
-            return AnnoListMessage(anno_list=items, has_more=more)
+        return cls.query_page(query, limit, projection, curs)
 
     @classmethod
     def is_anno_exists(cls, user, message):
-        query = cls.query() \
-            .filter(cls.app_name == message.app_name) \
-            .filter(cls.anno_text == message.anno_text) \
-            .filter(cls.anno_type == message.anno_type) \
-            .filter(cls.app_version == message.app_version) \
-            .filter(cls.level == message.level) \
-            .filter(cls.os_name == message.os_name) \
-            .filter(cls.os_version == message.os_version) \
-            .filter(cls.device_model == message.device_model) \
-            .filter(cls.screenshot_is_anonymized == message.screenshot_is_anonymized) \
-            .filter(cls.created == message.created) \
-            .filter(cls.simple_circle_on_top == message.simple_circle_on_top) \
-            .filter(cls.simple_x == message.simple_x) \
-            .filter(cls.simple_y == message.simple_y) \
-            .filter(cls.simple_is_moved == message.simple_is_moved)
-        for anno in query:
-            if anno.creator.id() == user.key.id():
-                return anno
-        return None
+        """
+        Find the anno of the given user which duplicates the request message, by a fingerprint key lookup.
+        An anno without created time in message is never a duplicate.
+        """
+        if message.created is None:
+            return None
+        fingerprint = cls.from_message(message, user).fingerprint
+        anno_fingerprint = AnnoFingerprint.get_by_id(fingerprint)
+        if anno_fingerprint is None:
+            return None
+        return anno_fingerprint.anno_key.get()
 
     @classmethod
     def query_my_anno(cls, user):
         query = cls.query().filter(cls.creator == user.key).order(-cls.last_update_time)
-        anno_list = []
-        for anno in query:
-            anno_message = anno.to_response_message()
-            anno_list.append(anno_message)
-        return anno_list
+        return cls.to_response_messages(query.fetch())
 
 
     @classmethod
-    def query_by_recent(cls, limit, offset, search_string, app_name, app_set):
+    def query_by_recent(cls, limit, offset, search_string, app_name, app_set, index_only=False, curs=None):
         """
         This method queries anno records by 'recent' order.
         'recent' = created
@@ -323,6 +552,8 @@ class Anno(BaseModel):
         :param search_string search string which partial-matches to anno_text.
         :param app_name app name which full-matches to app_name, this parameter is a single app name, not an app list.
         :param app_set app name set.
+        :param index_only whether to build results from search documents only, without datastore access.
+        :param curs search.Cursor to continue from, offset is ignored if it's provided.
         """
         index = search.Index(name="anno_index")
         # prepare pagination
@@ -337,17 +568,12 @@ class Anno(BaseModel):
                                      direction=search.SortExpression.DESCENDING,
                                      default_value=datetime.datetime.now())
         sort_opts = search.SortOptions(expressions=[sort])
-        query_options = search.QueryOptions(
-            limit=limit,
-            offset=offset,
-            sort_options=sort_opts,
-            returned_fields=['anno_text', 'app_name', 'created']
-        )
+        query_options = Anno.get_query_options(limit, offset, sort_opts, index_only, curs)
         # execute query
-        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit)
+        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit, index_only)
 
     @classmethod
-    def query_by_popular(cls, limit, offset, search_string, app_name, app_set):
+    def query_by_popular(cls, limit, offset, search_string, app_name, app_set, index_only=False, curs=None):
         """
         This method queries anno records by 'popular' order.
         'popular' = vote_count - flag_count
@@ -356,6 +582,8 @@ class Anno(BaseModel):
         :param search_string search string which partial-matches to anno_text.
         :param app_name app name which full-matches to app_name, this parameter is a single app name, not an app list.
         :param app_set app name set.
+        :param index_only whether to build results from search documents only, without datastore access.
+        :param curs search.Cursor to continue from, offset is ignored if it's provided.
         """
         index = search.Index(name="anno_index")
         # prepare pagination
@@ -369,17 +597,12 @@ class Anno(BaseModel):
         sort = search.SortExpression(expression="vote_count-flag_count",
                                      direction=search.SortExpression.DESCENDING, default_value=0)
         sort_opts = search.SortOptions(expressions=[sort])
-        query_options = search.QueryOptions(
-            limit=limit,
-            offset=offset,
-            sort_options=sort_opts,
-            returned_fields=['anno_text', 'app_name', 'vote_count', 'flag_count']
-        )
+        query_options = Anno.get_query_options(limit, offset, sort_opts, index_only, curs)
         # execute query
-        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit)
+        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit, index_only)
 
     @classmethod
-    def query_by_active(cls, limit, offset, search_string, app_name, app_set):
+    def query_by_active(cls, limit, offset, search_string, app_name, app_set, index_only=False, curs=None):
         """
         This method queries anno records by 'active' order.
         'active' = last_update_time
@@ -388,6 +611,8 @@ class Anno(BaseModel):
         :param search_string search string which partial-matches to anno_text.
         :param app_name app name which full-matches to app_name, this parameter is a single app name, not an app list.
         :param app_set app name set.
+        :param index_only whether to build results from search documents only, without datastore access.
+        :param curs search.Cursor to continue from, offset is ignored if it's provided.
         """
         index = search.Index(name="anno_index")
         # prepare pagination
@@ -400,13 +625,26 @@ class Anno(BaseModel):
                                      direction=search.SortExpression.DESCENDING,
                                      default_value=datetime.datetime.now())
         sort_opts = search.SortOptions(expressions=[sort])
-        query_options = search.QueryOptions(
-            limit=limit,
-            offset=offset,
-            sort_options=sort_opts,
-            returned_fields=['anno_text', 'app_name', 'last_update_time']
-        )
-        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit)
+        query_options = Anno.get_query_options(limit, offset, sort_opts, index_only, curs)
+        return Anno.convert_document_to_message(index, query_string, query_options, offset, limit, index_only)
+
+    @classmethod
+    def get_query_options(cls, limit, offset, sort_opts, index_only, curs=None):
+        """
+        This method returns search query options.
+        If index_only is True, documents are returned with all SEARCH_RESPONSE_FIELDS,
+        otherwise only document ids are returned and annos are loaded from datastore.
+        Pagination is done by search cursor, offset is only used if it's provided without cursor
+        (for backward compatibility).
+        """
+        if curs is None and offset > 0:
+            pagination = dict(offset=offset)
+        else:
+            pagination = dict(cursor=curs if curs is not None else search.Cursor())
+        if index_only:
+            return search.QueryOptions(limit=limit, sort_options=sort_opts,
+                                       returned_fields=cls.SEARCH_RESPONSE_FIELDS, **pagination)
+        return search.QueryOptions(limit=limit, sort_options=sort_opts, ids_only=True, **pagination)
 
     @classmethod
     def get_query_string(cls, search_string, app_name, app_set):
@@ -468,7 +706,7 @@ class Anno(BaseModel):
         return None
 
     @classmethod
-    def convert_document_to_message(cls, index, query_string, query_options, offset, limit):
+    def convert_document_to_message(cls, index, query_string, query_options, offset, limit, index_only=False):
         query = search.Query(query_string=query_string, options=query_options)
         results = index.search(query)
         number_retrieved = len(results.results)
@@ -477,18 +715,58 @@ class Anno(BaseModel):
         if number_retrieved > 0:
             has_more = (number_retrieved == limit)
             offset += number_retrieved
-            for result in results:
-                anno = Anno.get_by_id(long(result.doc_id))
-                anno_list.append(anno.to_response_message())
-        return AnnoListMessage(anno_list=anno_list, offset=offset, has_more=has_more)
+        next_cursor = None
+        if query_options.cursor is not None:
+            # search service returns no cursor when there are no more results.
+            has_more = results.cursor is not None
+            if has_more:
+                next_cursor = results.cursor.web_safe_string
+        if number_retrieved > 0 and index_only:
+            anno_list = [cls.convert_scored_document_to_message(result) for result in results]
+        elif number_retrieved > 0:
+            annos = ndb.get_multi([ndb.Key(Anno, long(result.doc_id)) for result in results])
+            # documents of deleted annos may still be in index, drop them and remove them from index.
+            stale_doc_ids = [result.doc_id for result, anno in zip(results, annos) if anno is None]
+            if len(stale_doc_ids) > 0:
+                logging.warning("annos(%s) don't exist, removing their search documents." % ', '.join(stale_doc_ids))
+                deferred.defer(delete_search_documents, stale_doc_ids)
+            annos = [anno for anno in annos if anno is not None]
+            creators = cls.resolve_creators(annos)
+            for anno in annos:
+                anno_list.append(anno.to_response_message(creators))
+        return AnnoListMessage(anno_list=anno_list, offset=offset, cursor=next_cursor, has_more=has_more)
 
-    def generate_search_document(self):
+    @classmethod
+    def convert_scored_document_to_message(cls, document):
+        """
+        This method builds AnnoResponseMessage from fields of a scored search document, no datastore access.
+        """
+        fields = dict((field.name, field.value) for field in document.fields)
+        anno_message = AnnoResponseMessage(id=long(document.doc_id))
+        for name in ['anno_text', 'app_name', 'anno_type', 'app_version', 'device_model', 'os_name', 'os_version',
+                     'country', 'created', 'last_update_time', 'last_activity', 'simple_x', 'simple_y']:
+            if fields.get(name) is not None:
+                setattr(anno_message, name, fields[name])
+        for name in ['level', 'vote_count', 'flag_count', 'followup_count', 'activity_count']:
+            if fields.get(name) is not None:
+                setattr(anno_message, name, int(fields[name]))
+        if fields.get('simple_circle_on_top') is not None:
+            anno_message.simple_circle_on_top = bool(fields['simple_circle_on_top'])
+        if fields.get('creator_id') is not None:
+            anno_message.creator = UserMessage(id=long(fields['creator_id']),
+                                               display_name=fields.get('creator_display_name'))
+        return anno_message
+
+    def generate_search_document(self, creators=None):
         """
         This method generates a search document filled with current anno information.
+        Document carries all fields of an anno list item, so that search results can be served from index only.
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
         anno_id_string = "%d" % self.key.id()
         app_name = "%s" % self.app_name
         anno_text = "%s" % self.anno_text
+        creator = self.get_creator_message(creators)
         anno_document = search.Document(
             doc_id=anno_id_string,
             fields=[
@@ -497,18 +775,153 @@ class Anno(BaseModel):
                 search.NumberField(name='vote_count', value=self.vote_count),
                 search.NumberField(name='flag_count', value=self.flag_count),
                 search.DateField(name='created', value=self.created),
-                search.DateField(name='last_update_time', value=self.last_update_time)
+                search.DateField(name='last_update_time', value=self.last_update_time),
+                search.NumberField(name='followup_count', value=self.followup_count or 0),
+                search.NumberField(name='activity_count', value=self.activity_count or 0),
+                search.AtomField(name='anno_type', value=self.anno_type),
+                search.NumberField(name='simple_x', value=self.simple_x),
+                search.NumberField(name='simple_y', value=self.simple_y),
+                search.NumberField(name='simple_circle_on_top', value=1 if self.simple_circle_on_top else 0),
+                search.NumberField(name='level', value=self.level),
+                search.AtomField(name='app_version', value=self.app_version),
+                search.AtomField(name='device_model', value=self.device_model),
+                search.AtomField(name='os_name', value=self.os_name),
+                search.AtomField(name='os_version', value=self.os_version),
+                search.AtomField(name='country', value=self.country),
+                search.AtomField(name='last_activity', value=self.last_activity),
+                search.AtomField(name='creator_id', value="%d" % creator.id if creator is not None else None),
+                search.AtomField(name='creator_display_name',
+                                 value=creator.display_name if creator is not None else None)
             ]
         )
         return anno_document
 
+    @classmethod
+    def migrate_screenshot(cls, cursor=None, batch_size=50):
+        """
+        This method moves legacy screenshots out of anno entities into Screenshot.
+        Annos are processed batch by batch, each batch defers the next one.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many annos to process in one batch.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        annos, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        legacy_annos = [anno for anno in annos if anno.image is not None]
+        migrated = 0
+        if len(legacy_annos) > 0:
+            keys = Screenshot.save_images([anno.image for anno in legacy_annos])
+            futures = [cls._move_screenshot_async(anno.key, key) for anno, key in zip(legacy_annos, keys)]
+            migrated = len([future for future in futures if future.get_result()])
+        logging.info("migrated %d screenshots in a batch of %d annos." % (migrated, len(annos)))
+        if more and next_curs is not None:
+            deferred.defer(cls.migrate_screenshot, cursor=next_curs.urlsafe(), batch_size=batch_size)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _move_screenshot_async(cls, anno_key, screenshot_key):
+        # the anno is read again, it's left alone if its screenshot changed after the batch fetch.
+        anno = yield anno_key.get_async()
+        if anno is None or anno.image is None or Screenshot.get_key(anno.image) != screenshot_key:
+            raise ndb.Return(False)
+        anno.screenshot_key = screenshot_key
+        anno.image = None
+        yield anno.put_async()
+        raise ndb.Return(True)
+
+    @classmethod
+    def backfill_activity_count(cls, cursor=None, batch_size=100, mismatched=0, processed=0):
+        """
+        This method checks activity_count of existing annos against vote/flag/followup counts, and fixes
+        the mismatched ones. Annos are processed batch by batch, each batch defers the next one.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many annos to process in one batch.
+        :param mismatched: how many mismatched annos found in previous batches.
+        :param processed: how many annos processed in previous batches.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        annos, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        futures = []
+        for anno in annos:
+            activity_count = anno.compute_activity_count()
+            if anno.activity_count != activity_count:
+                logging.info("anno(%s) activity_count %s doesn't match %s." %
+                             (anno.key.id(), anno.activity_count, activity_count))
+                futures.append(cls._fix_activity_count_async(anno.key))
+        mismatched += len([future for future in futures if future.get_result()])
+        processed += len(annos)
+        if more and next_curs is not None:
+            deferred.defer(cls.backfill_activity_count, cursor=next_curs.urlsafe(), batch_size=batch_size,
+                           mismatched=mismatched, processed=processed)
+        else:
+            logging.info("activity_count backfill finished, %d of %d annos fixed." % (mismatched, processed))
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _fix_activity_count_async(cls, anno_key):
+        # the anno is read again, so counts changed by a concurrent request after the batch fetch are kept.
+        anno = yield anno_key.get_async()
+        if anno is None or anno.activity_count == anno.compute_activity_count():
+            raise ndb.Return(False)
+        anno.activity_count = anno.compute_activity_count()
+        yield anno.put_async()
+        raise ndb.Return(True)
+
+    @classmethod
+    def backfill_fingerprint(cls, cursor=None, batch_size=100):
+        """
+        This method computes fingerprint of existing annos and claims it.
+        Annos are processed batch by batch, each batch defers the next one. Only annos whose fingerprint
+        changed or isn't claimed are written, each of them in its own transaction.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many annos to process in one batch.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        annos, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        fingerprints = [anno.compute_fingerprint() for anno in annos]
+        fingerprint_keys = [ndb.Key(AnnoFingerprint, fingerprint) for fingerprint in fingerprints]
+        futures = []
+        for anno, fingerprint, anno_fingerprint in zip(annos, fingerprints, ndb.get_multi(fingerprint_keys)):
+            if anno.fingerprint != fingerprint or anno_fingerprint is None:
+                futures.append(cls._backfill_fingerprint_async(anno.key))
+            elif anno_fingerprint.anno_key != anno.key:
+                logging.info("anno(%s) duplicates anno(%s)." % (anno.key.id(), anno_fingerprint.anno_key.id()))
+        for future in futures:
+            anno_key, owner_key = future.get_result()
+            if owner_key is not None and owner_key != anno_key:
+                logging.info("anno(%s) duplicates anno(%s)." % (anno_key.id(), owner_key.id()))
+        if more and next_curs is not None:
+            deferred.defer(cls.backfill_fingerprint, cursor=next_curs.urlsafe(), batch_size=batch_size)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _backfill_fingerprint_async(cls, anno_key):
+        # the anno is read again, so changes committed after the batch fetch are kept.
+        anno = yield anno_key.get_async()
+        if anno is None:
+            raise ndb.Return((anno_key, None))
+        fingerprint = anno.compute_fingerprint()
+        fingerprint_key = ndb.Key(AnnoFingerprint, fingerprint)
+        anno_fingerprint = yield fingerprint_key.get_async()
+        futures = []
+        if anno_fingerprint is None:
+            anno_fingerprint = AnnoFingerprint(key=fingerprint_key, anno_key=anno_key)
+            futures.append(anno_fingerprint.put_async())
+        if anno.fingerprint != fingerprint:
+            anno.fingerprint = fingerprint
+            futures.append(anno.put_async())
+        yield futures
+        raise ndb.Return((anno_key, anno_fingerprint.anno_key))
+
     @classmethod
     def query_anno_by_author(cls, user):
         """
         This methods return all annos created by the given user.
         """
-        query = cls.query().filter(cls.creator == user.key).order(-cls.last_update_time)
-        anno_list = []
-        for anno in query:
-            anno_list.append(anno)
-        return anno_list
\ No newline at end of file
+        return cls.query_anno_by_author_async(user).get_result()
+
+    @classmethod
+    def query_anno_by_author_async(cls, user):
+        """
+        Async version of query_anno_by_author, returns a future of anno list.
+        """
+        return cls.query().filter(cls.creator == user.key).order(-cls.last_update_time).fetch_async()
\ No newline at end of file
@@ -0,0 +1,91 @@
+__author__ = 'topcircler'
+
+"""
+Background deletion of the entities which belong to an anno: votes, flags, followups, "my stuff" activities
+and counter shards.
+
+Deleting an anno only removes the anno itself, its children are removed by a deferred task chain. Each task
+deletes one batch of one child kind by a keys-only query and delete_multi, then defers the next batch with
+the kind and cursor it reached, so no task runs into the request deadline.
+
+sweep_orphans walks all children and deletes the ones whose anno no longer exists, it purges orphans left
+by deletes made before the cascade existed.
+"""
+
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.base_model import BaseModel
+from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
+from model.vote import Vote
+from model.flag import Flag
+from model.follow_up import FollowUp
+from model.user_anno_activity import UserAnnoActivity
+
+# child models, each of them has an anno_key property.
+CHILD_MODELS = [Vote, Flag, FollowUp, UserAnnoActivity, AnnoCounterShard]
+DELETE_BATCH_SIZE = 200
+SWEEP_BATCH_SIZE = 500
+
+
+def delete_anno_children(anno_id, model_index=0, cursor=None, deleted=0):
+    """
+    Delete children of a deleted anno batch by batch, each batch defers the next one.
+    :param anno_id: id of the deleted anno.
+    :param model_index: index in CHILD_MODELS of the kind being deleted.
+    :param cursor: urlsafe cursor of the next batch of the kind.
+    :param deleted: how many children deleted in previous batches.
+    """
+    model = CHILD_MODELS[model_index]
+    curs = Cursor(urlsafe=cursor) if cursor is not None else None
+    query = model.query(model.anno_key == ndb.Key(Anno, anno_id))
+    keys, next_curs, more = query.fetch_page(DELETE_BATCH_SIZE, start_cursor=curs, keys_only=True)
+    delete_children(model, keys)
+    deleted += len(keys)
+    if more and next_curs is not None:
+        deferred.defer(delete_anno_children, anno_id, model_index=model_index, cursor=next_curs.urlsafe(),
+                       deleted=deleted)
+    elif model_index + 1 < len(CHILD_MODELS):
+        deferred.defer(delete_anno_children, anno_id, model_index=model_index + 1, deleted=deleted)
+    else:
+        logging.info("deleted %d children of anno(%d)." % (deleted, anno_id))
+
+
+def delete_children(model, keys):
+    """
+    Delete children of the given model, deletes of anno models are recorded into the change log.
+    """
+    if issubclass(model, BaseModel):
+        model.delete_multi(keys)
+    else:
+        ndb.delete_multi(keys)
+
+
+def sweep_orphans(model_index=0, cursor=None, deleted=0):
+    """
+    Delete children whose anno no longer exists, children are walked batch by batch and kind by kind,
+    each batch defers the next one.
+    :param model_index: index in CHILD_MODELS of the kind being swept.
+    :param cursor: urlsafe cursor of the next batch of the kind.
+    :param deleted: how many orphans deleted in previous batches.
+    """
+    model = CHILD_MODELS[model_index]
+    curs = Cursor(urlsafe=cursor) if cursor is not None else None
+    # projection on anno_key is served by its built-in index, child entities are not fetched.
+    children, next_curs, more = model.query().fetch_page(SWEEP_BATCH_SIZE, start_cursor=curs,
+                                                         projection=[model.anno_key])
+    anno_keys = list(set(child.anno_key for child in children))
+    existing_keys = set(anno.key for anno in ndb.get_multi(anno_keys) if anno is not None)
+    orphan_keys = [child.key for child in children if child.anno_key not in existing_keys]
+    delete_children(model, orphan_keys)
+    deleted += len(orphan_keys)
+    if more and next_curs is not None:
+        deferred.defer(sweep_orphans, model_index=model_index, cursor=next_curs.urlsafe(), deleted=deleted)
+    elif model_index + 1 < len(CHILD_MODELS):
+        deferred.defer(sweep_orphans, model_index=model_index + 1, deleted=deleted)
+    else:
+        logging.info("orphan sweep finished, %d orphans deleted." % deleted)
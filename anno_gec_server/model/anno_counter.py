@@ -0,0 +1,238 @@
+__author__ = 'topcircler'
+
+"""
+Sharded counter data store model definition for anno vote/flag/followup counts.
+"""
+
+import datetime
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.anno import Anno
+from api.search_index import mark_search_document_dirty
+
+
+class AnnoCounterShard(ndb.Model):
+    """
+    This class represents one shard of an anno counter.
+
+    A counter value is the sum of all its shards. Increments go to a random shard in a transaction,
+    so writes on a popular anno are spread over NUM_SHARDS entity groups instead of the anno itself.
+    Totals are rolled up into the denormalized anno fields periodically.
+    """
+    anno_key = ndb.KeyProperty(kind=Anno)
+    metric = ndb.StringProperty()
+    count = ndb.IntegerProperty(default=0)
+    last_increment_time = ndb.DateTimeProperty()
+
+    NUM_SHARDS = 20
+    ROLLUP_DELAY = 10  # seconds between a counter change and its roll-up into anno.
+    CACHE_TIME = 60  # seconds to cache counter totals in memcache.
+    DELETE_CHUNK_SIZE = 100  # entities deleted by one batch delete in delete_counted.
+    # counter metric name -> activity name which is saved into anno.last_activity.
+    METRICS = {'vote_count': 'vote', 'flag_count': 'flag', 'followup_count': 'follwup'}
+
+    @classmethod
+    def get_shard_key(cls, anno_key, metric, index):
+        return ndb.Key(cls, "%d-%s-%d" % (anno_key.id(), metric, index))
+
+    @classmethod
+    def get_shard_keys(cls, anno_key, metric):
+        return [cls.get_shard_key(anno_key, metric, index) for index in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def get_cache_key(cls, anno_key, metric):
+        return "anno_counter:%d:%s" % (anno_key.id(), metric)
+
+    @classmethod
+    def increment(cls, anno, metric, delta=1):
+        """
+        Increment an anno counter by delta, and schedule a roll-up into anno.
+        :param anno: anno entity.
+        :param metric: 'vote_count', 'flag_count' or 'followup_count'.
+        :param delta: can be negative.
+        """
+        cls.seed(anno, metric)
+        cls.increment_shard(anno.key, metric, delta)
+        cls.counter_changed(anno.key, metric, delta)
+
+    @classmethod
+    def increment_shard(cls, anno_key, metric, delta):
+        """
+        Increment a random shard of a seeded anno counter by delta. It joins the transaction of the caller
+        if there is one, so the change commits together with the caller's writes. Call counter_changed after
+        the transaction commits.
+        """
+        cls.increment_shard_async(anno_key, metric, delta).get_result()
+
+    @classmethod
+    def increment_shard_async(cls, anno_key, metric, delta):
+        """
+        Async version of increment_shard, returns a future.
+        """
+        shard_key = cls.get_shard_key(anno_key, metric, random.randint(0, cls.NUM_SHARDS - 1))
+        return cls._increment_shard_async(shard_key, anno_key, metric, delta)
+
+    @classmethod
+    def counter_changed(cls, anno_key, metric, delta):
+        """
+        Update cached total of a changed anno counter, and schedule a roll-up into anno.
+        """
+        cache_key = cls.get_cache_key(anno_key, metric)
+        if delta > 0:
+            memcache.incr(cache_key, delta)
+        elif delta < 0:
+            memcache.decr(cache_key, -delta)
+        Anno.invalidate_cache(anno_key.id())
+        cls.schedule_rollup(anno_key)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def _increment_shard_async(cls, shard_key, anno_key, metric, delta):
+        shard = yield shard_key.get_async()
+        if shard is None:
+            shard = cls(key=shard_key, anno_key=anno_key, metric=metric, count=0)
+        shard.count += delta
+        if delta > 0:
+            shard.last_increment_time = datetime.datetime.now()
+        yield shard.put_async()
+
+    @classmethod
+    def delete_counted(cls, anno, keys, metric, creator_keys=None):
+        """
+        Delete entities counted by an anno counter(votes or flags on the anno) chunk by chunk, each chunk of
+        DELETE_CHUNK_SIZE entities is read by one batch get, deleted by one batch delete and decreases the counter
+        by one shard increment, so the counter only drops by what is found.
+        Entities deleted concurrently by another request between the get and the delete can be counted twice,
+        such drift is fixed by the counter reconciler. Returns creator keys of the deleted entities.
+        :param keys: keys of the entities, missing ones are skipped.
+        :param creator_keys: only entities of these creators are deleted, None for all.
+        """
+        cls.seed(anno, metric)
+        creator_key_set = set(creator_keys) if creator_keys is not None else None
+        deleted = []
+        for index in range(0, len(keys), cls.DELETE_CHUNK_SIZE):
+            entities = [entity for entity in ndb.get_multi(keys[index:index + cls.DELETE_CHUNK_SIZE])
+                        if entity is not None and entity.creator is not None and
+                        (creator_key_set is None or entity.creator in creator_key_set)]
+            if len(entities) == 0:
+                continue
+            type(entities[0]).delete_multi([entity.key for entity in entities])
+            cls.increment_shard(anno.key, metric, -len(entities))
+            deleted.extend(entity.creator for entity in entities)
+        if len(deleted) > 0:
+            cls.counter_changed(anno.key, metric, -len(deleted))
+        return deleted
+
+    @classmethod
+    def seed(cls, anno, metric):
+        """
+        Make sure shard 0 of a counter exists, it's seeded with the current denormalized anno count
+        so that counts of annos created before sharding are kept.
+        """
+        shard_key = cls.get_shard_key(anno.key, metric, 0)
+        if shard_key.get() is None:
+            cls._seed_shard(shard_key, anno.key, metric, getattr(anno, metric) or 0)
+
+    @classmethod
+    @ndb.transactional
+    def _seed_shard(cls, shard_key, anno_key, metric, count):
+        if shard_key.get() is None:
+            cls(key=shard_key, anno_key=anno_key, metric=metric, count=count).put()
+
+    @classmethod
+    def get_counts(cls, anno):
+        """
+        Get up-to-date totals of all counters of the given anno, totals are cached in memcache.
+        Returns a dict which maps metric to count.
+        """
+        cache_keys = dict((metric, cls.get_cache_key(anno.key, metric)) for metric in cls.METRICS)
+        cached = memcache.get_multi(cache_keys.values())
+        counts = {}
+        missing_metrics = []
+        for metric, cache_key in cache_keys.iteritems():
+            if cache_key in cached:
+                counts[metric] = cached[cache_key]
+            else:
+                missing_metrics.append(metric)
+        if len(missing_metrics) > 0:
+            totals = cls.sum_shards(anno.key, missing_metrics)
+            for metric in missing_metrics:
+                counts[metric] = totals[metric][0] if metric in totals else (getattr(anno, metric) or 0)
+            memcache.add_multi(dict((cache_keys[metric], counts[metric]) for metric in missing_metrics),
+                               time=cls.CACHE_TIME)
+        return counts
+
+    @classmethod
+    def sum_shards(cls, anno_key, metrics):
+        """
+        Sum up shards of the given counters by one batch get.
+        Returns a dict which maps metric to (total, last increment time), counters without shard are absent.
+        """
+        keys = []
+        for metric in metrics:
+            keys.extend(cls.get_shard_keys(anno_key, metric))
+        totals = {}
+        for shard in ndb.get_multi(keys):
+            if shard is None:
+                continue
+            total, last_increment_time = totals.get(shard.metric, (0, None))
+            if shard.last_increment_time is not None and \
+                    (last_increment_time is None or shard.last_increment_time > last_increment_time):
+                last_increment_time = shard.last_increment_time
+            totals[shard.metric] = (total + shard.count, last_increment_time)
+        return totals
+
+    @classmethod
+    def schedule_rollup(cls, anno_key):
+        """
+        Schedule a roll-up task for the given anno, all counter changes within ROLLUP_DELAY share one task.
+        """
+        window = int(time.time() / cls.ROLLUP_DELAY)
+        try:
+            deferred.defer(cls.rollup, anno_key.id(), _countdown=cls.ROLLUP_DELAY,
+                           _name="anno-counter-rollup-%d-%d" % (anno_key.id(), window))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def rollup(cls, anno_id):
+        """
+        Roll counter totals up into the denormalized anno fields, and mark search document dirty.
+        Latest counter increment also updates anno last activity.
+        """
+        anno_key = ndb.Key(Anno, anno_id)
+        totals = cls.sum_shards(anno_key, cls.METRICS.keys())
+        if len(totals) == 0:
+            return
+        anno = cls._rollup_anno(anno_key, totals)
+        if anno is None:
+            return
+        memcache.set_multi(dict((cls.get_cache_key(anno_key, metric), getattr(anno, metric))
+                                for metric in cls.METRICS), time=cls.CACHE_TIME)
+        Anno.invalidate_cache(anno_id)
+        mark_search_document_dirty(anno_id)
+
+    @classmethod
+    @ndb.transactional
+    def _rollup_anno(cls, anno_key, totals):
+        anno = anno_key.get()
+        if anno is None:
+            logging.info("anno(%s) doesn't exist, skip counter roll-up." % anno_key.id())
+            return None
+        for metric, (total, last_increment_time) in totals.iteritems():
+            setattr(anno, metric, total)
+            if last_increment_time is not None and \
+                    (anno.last_update_time is None or last_increment_time > anno.last_update_time):
+                anno.last_update_time = last_increment_time
+                anno.last_activity = cls.METRICS[metric]
+                anno.last_update_type = 'create'
+        anno.activity_count = anno.compute_activity_count()
+        anno.put()
+        return anno
@@ -0,0 +1,17 @@
+__author__ = 'topcircler'
+
+"""
+Anno fingerprint data store model definition.
+"""
+
+from google.appengine.ext import ndb
+
+
+class AnnoFingerprint(ndb.Model):
+    """
+    This class represents a claimed anno fingerprint, it's keyed by the fingerprint and refers to the anno owning it.
+
+    Duplicate anno detection is a key lookup against this kind.
+    """
+    anno_key = ndb.KeyProperty(kind='Anno')
+    created = ndb.DateTimeProperty(auto_now_add=True)
@@ -3,11 +3,74 @@ __author__ = 'topcircler'
 from google.appengine.ext import ndb
 
 from model.user import User
+from model.entity_change import EntityChange
 
 
 class BaseModel(ndb.Model):
     """
     Base model for all anno models.
+
+    Puts and deletes of anno models are recorded into the change log in the same transaction, see EntityChange.
+    Deletes are recorded only if they are made by delete_multi.
     """
     created = ndb.DateTimeProperty(auto_now_add=True)
-    creator = ndb.KeyProperty(kind=User)
\ No newline at end of file
+    creator = ndb.KeyProperty(kind=User)
+
+    @classmethod
+    def resolve_creators(cls, entities):
+        """
+        Batch-resolve creators of the given entities.
+
+        All creator keys are fetched by one ndb.get_multi, returns a dict which maps creator key to UserMessage.
+        The dict can be passed to to_message/to_response_message so that a list page costs one user RPC.
+        """
+        return User.get_user_message_map([entity.creator for entity in entities if entity is not None])
+
+    def get_creator_message(self, creators=None):
+        """
+        Get UserMessage of the creator, look it up in the given resolved creators first.
+        """
+        if self.creator is None:
+            return None
+        if creators is None:
+            creators = BaseModel.resolve_creators([self])
+        return creators.get(self.creator)
+
+    def get_change_anno_id(self):
+        """
+        Returns id of the anno which this entity belongs to, it's recorded with changes.
+        """
+        return self.anno_key.id() if self.anno_key is not None else None
+
+    @ndb.tasklet
+    def _put_async(self, **ctx_options):
+        """
+        Put this entity and record its change, a put_multi of a batch records the changes concurrently.
+        """
+        key = yield super(BaseModel, self)._put_async(**ctx_options)
+        yield EntityChange.record_async(key, self.get_change_anno_id())
+        raise ndb.Return(key)
+    put_async = _put_async
+
+    @classmethod
+    def get_deleted_anno_id(cls, key):
+        """
+        Returns id of the anno which the deleted entity of the given key belongs to, None keeps the recorded one.
+        """
+        return None
+
+    @classmethod
+    def delete_multi(cls, keys):
+        """
+        Delete entities of the given keys and record their deletes, the changes are recorded concurrently.
+        """
+        cls.delete_multi_async(keys).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def delete_multi_async(cls, keys):
+        """
+        Async version of delete_multi, returns a future.
+        """
+        yield ndb.delete_multi_async(keys)
+        yield [EntityChange.record_async(key, cls.get_deleted_anno_id(key), deleted=True) for key in keys]
@@ -0,0 +1,154 @@
+__author__ = 'topcircler'
+
+"""
+Reconciliation of denormalized anno counters.
+
+vote_count, flag_count and followup_count of anno (and the counter shards behind them, see AnnoCounterShard)
+can drift from the real number of votes, flags and followups, e.g. by failed increments or data copied
+without counters. reconcile_counters walks all annos batch by batch, recomputes the real counts by keys-only
+count queries and fixes annos and shards whose counts differ. Only changed annos are re-indexed.
+
+Count queries are eventually consistent, so annos whose counters were incremented within RECENT_INCREMENT_TIME
+are skipped. A counter is fixed in a transaction which re-reads the anno and its shards, it's left to the next
+run if they changed after they were counted.
+
+Drift statistics of the current/last run are kept in memcache, see get_reconcile_stats.
+"""
+
+import datetime
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.anno import Anno
+from model.anno_counter import AnnoCounterShard
+from model.vote import Vote
+from model.flag import Flag
+from model.follow_up import FollowUp
+from api.search_index import mark_search_documents_dirty
+
+# counter metric -> model whose entities are counted.
+COUNTED_MODELS = {'vote_count': Vote, 'flag_count': Flag, 'followup_count': FollowUp}
+RECONCILE_BATCH_SIZE = 50
+RECENT_INCREMENT_TIME = datetime.timedelta(minutes=1)
+STATS_KEY = "counter_reconcile_stats"
+
+
+def new_stats():
+    stats = {'checked': 0, 'changed': 0, 'skipped': 0, 'max_drift': 0, 'started_time': int(time.time()),
+             'finished_time': None}
+    for metric in COUNTED_MODELS:
+        stats[metric + '_mismatches'] = 0
+        stats[metric + '_drift'] = 0  # sum of absolute differences between stored and real counts.
+    return stats
+
+
+def reconcile_counters(cursor=None, batch_size=RECONCILE_BATCH_SIZE, stats=None):
+    """
+    Recompute counts of a batch of annos and fix the ones which drift, each batch defers the next one.
+    :param cursor: urlsafe cursor of the next batch.
+    :param batch_size: how many annos to process in one batch.
+    :param stats: drift statistics of previous batches.
+    """
+    if stats is None:
+        stats = new_stats()
+    curs = Cursor(urlsafe=cursor) if cursor is not None else None
+    annos, next_curs, more = Anno.query().fetch_page(batch_size, start_cursor=curs)
+
+    # count queries of the whole batch run concurrently.
+    count_futures = [dict((metric, model.query(model.anno_key == anno.key).count_async())
+                          for metric, model in COUNTED_MODELS.iteritems()) for anno in annos]
+    shard_keys = []
+    for anno in annos:
+        for metric in COUNTED_MODELS:
+            shard_keys.extend(AnnoCounterShard.get_shard_keys(anno.key, metric))
+    shards = {}
+    for shard in ndb.get_multi(shard_keys):
+        if shard is not None:
+            shards.setdefault((shard.anno_key, shard.metric), []).append(shard)
+
+    recent_time = datetime.datetime.now() - RECENT_INCREMENT_TIME  # shards keep local time, see AnnoCounterShard.
+    changed_anno_ids = []
+    cache_keys = []
+    for anno, futures in zip(annos, count_futures):
+        if any(shard.last_increment_time is not None and shard.last_increment_time > recent_time
+               for metric in COUNTED_MODELS for shard in shards.get((anno.key, metric), [])):
+            stats['skipped'] += 1
+            continue
+        changed = False
+        for metric, future in futures.iteritems():
+            count = future.get_result()
+            anno_count = getattr(anno, metric) or 0
+            shard_count = sum_shards(shards.get((anno.key, metric), []), count)
+            if anno_count == count and shard_count == count:
+                continue
+            drift = max(abs(anno_count - count), abs(shard_count - count))
+            stats[metric + '_mismatches'] += 1
+            stats[metric + '_drift'] += drift
+            stats['max_drift'] = max(stats['max_drift'], drift)
+            if fix_counter(anno.key, metric, anno_count, shard_count, count):
+                changed = True
+                cache_keys.append(AnnoCounterShard.get_cache_key(anno.key, metric))
+        if changed:
+            changed_anno_ids.append(anno.key.id())
+
+    memcache.delete_multi(cache_keys)
+    for anno_id in changed_anno_ids:
+        Anno.invalidate_cache(anno_id)
+    mark_search_documents_dirty(changed_anno_ids)
+
+    stats['checked'] += len(annos)
+    stats['changed'] += len(changed_anno_ids)
+    if more and next_curs is not None:
+        memcache.set(STATS_KEY, stats)
+        deferred.defer(reconcile_counters, cursor=next_curs.urlsafe(), batch_size=batch_size, stats=stats)
+    else:
+        stats['finished_time'] = int(time.time())
+        memcache.set(STATS_KEY, stats)
+        logging.info("counter reconciliation finished: %s" % stats)
+
+
+def sum_shards(metric_shards, count):
+    """
+    Returns total of the given shards of a counter, a counter without shard is served by anno field, its total
+    is taken as the real count.
+    """
+    return sum(shard.count for shard in metric_shards) if len(metric_shards) > 0 else count
+
+
+@ndb.transactional(xg=True)
+def fix_counter(anno_key, metric, anno_count, shard_count, count):
+    """
+    Set an anno counter and its shards to the real count, the anno and NUM_SHARDS shards fit in one transaction.
+    Returns False if the anno is deleted or the counter changed after anno_count and shard_count were read.
+    """
+    anno = anno_key.get()
+    metric_shards = [shard for shard in ndb.get_multi(AnnoCounterShard.get_shard_keys(anno_key, metric))
+                     if shard is not None]
+    if anno is None or (getattr(anno, metric) or 0) != anno_count or sum_shards(metric_shards, count) != shard_count:
+        return False
+    setattr(anno, metric, count)
+    anno.activity_count = anno.compute_activity_count()
+    changed_entities = [anno]
+    if len(metric_shards) > 0:
+        # reset the counter to one shard which holds the real count.
+        increment_times = [shard.last_increment_time for shard in metric_shards if shard.last_increment_time]
+        seed_shard = AnnoCounterShard(key=AnnoCounterShard.get_shard_key(anno_key, metric, 0),
+                                      anno_key=anno_key, metric=metric, count=count,
+                                      last_increment_time=max(increment_times) if len(increment_times) > 0 else None)
+        changed_entities.append(seed_shard)
+        ndb.delete_multi([shard.key for shard in metric_shards if shard.key != seed_shard.key])
+    ndb.put_multi(changed_entities)
+    return True
+
+
+def get_reconcile_stats():
+    """
+    Returns drift statistics of the current or last reconciliation, None if there is none since memcache
+    was last flushed. finished_time is None while reconciliation is running.
+    """
+    return memcache.get(STATS_KEY)
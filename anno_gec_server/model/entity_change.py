@@ -0,0 +1,138 @@
+__author__ = 'topcircler'
+
+"""
+Change log data store model definition, it backs the incremental sync API.
+"""
+
+import base64
+import calendar
+import datetime
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class EntityChange(ndb.Model):
+    """
+    This class represents the latest change of an anno, vote, flag or followup.
+
+    There is one row per entity, so the log only grows with the number of entities. The row is a child of
+    the entity, it's written in the transaction which writes the entity without adding an entity group.
+    Every put/delete of a tracked entity (see BaseModel) rewrites the row with a new updated time, version is
+    a counter of the entity's changes which the rewrite increases in the same transaction, so it increases on
+    every change of the entity, also across a delete and re-insert of the same key.
+    Deleted entities leave a tombstone row.
+    """
+    kind = ndb.StringProperty(indexed=False)  # 'anno', 'vote', 'flag' or 'followup'.
+    entity_key = ndb.KeyProperty(indexed=False)
+    anno_id = ndb.IntegerProperty(indexed=False)
+    deleted = ndb.BooleanProperty(default=False, indexed=False)
+    version = ndb.IntegerProperty(indexed=False)
+    updated = ndb.DateTimeProperty()
+
+    SETTLE_LAG = 5  # seconds, changes newer than this are not returned since earlier changes may still commit.
+
+    @classmethod
+    def get_key(cls, entity_key):
+        return ndb.Key(cls, 1, parent=entity_key)
+
+    @classmethod
+    def record(cls, entity_key, anno_id, deleted=False):
+        cls.record_async(entity_key, anno_id, deleted).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def record_async(cls, entity_key, anno_id, deleted=False):
+        """
+        Record a change of the given entity, returns a future.
+        It joins the transaction which writes the entity if there is one, otherwise it runs in its own transaction
+        on the entity group. Rows of concurrent records in one transaction are read and written in batches.
+        :param anno_id: id of the anno which the entity belongs to, None keeps the recorded one.
+        """
+        change_key = cls.get_key(entity_key)
+        change = yield change_key.get_async()
+        if change is None:
+            change = cls(key=change_key, kind=entity_key.kind().lower(), entity_key=entity_key, version=0)
+        if anno_id is not None:
+            change.anno_id = anno_id
+        change.deleted = deleted
+        change.version += 1
+        change.updated = datetime.datetime.utcnow()
+        yield change.put_async()
+
+    @classmethod
+    def backfill(cls, kind, cursor=None, batch_size=200):
+        """
+        This method records existing entities of the given kind which have no change yet, so that a full sync
+        returns them. Entities are processed batch by batch, each batch defers the next one.
+        :param kind: 'Anno', 'Vote', 'Flag' or 'FollowUp'.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many entities to process in one batch.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        entities, next_curs, more = ndb.Query(kind=kind).fetch_page(batch_size, start_cursor=curs)
+        change_keys = [cls.get_key(entity.key) for entity in entities]
+        now = datetime.datetime.utcnow()
+        changes = [cls(key=change_key, kind=entity.key.kind().lower(), entity_key=entity.key,
+                       anno_id=entity.get_change_anno_id(), version=1, updated=now)
+                   for entity, change_key, change in zip(entities, change_keys, ndb.get_multi(change_keys))
+                   if change is None]
+        ndb.put_multi(changes)
+        if more and next_curs is not None:
+            deferred.defer(cls.backfill, kind, cursor=next_curs.urlsafe(), batch_size=batch_size)
+        else:
+            logging.info("%s change log backfill finished." % kind)
+
+    @classmethod
+    def query_since(cls, token, limit):
+        """
+        Query changes after the given sync token in (updated, key) order.
+        :param token: sync token returned by previous call, None for all changes.
+        Returns (change list, next token, more).
+        """
+        since, last_entity_key = parse_token(token)
+        until = datetime.datetime.utcnow() - datetime.timedelta(seconds=cls.SETTLE_LAG)
+        query = cls.query(cls.updated >= since, cls.updated < until).order(cls.updated, cls.key)
+        changes = []
+        more = False
+        # changes at the token time which are already returned are skipped.
+        for change in query.iter(batch_size=limit + 1):
+            # change keys are ordered by their parent entity keys, pairs compare the same way.
+            if change.updated == since and last_entity_key is not None and \
+                    change.entity_key.pairs() <= last_entity_key.pairs():
+                continue
+            if len(changes) == limit:
+                more = True
+                break
+            changes.append(change)
+        if len(changes) > 0:
+            next_token = build_token(changes[-1].updated, changes[-1].entity_key)
+        else:
+            next_token = token
+        return changes, next_token, more
+
+
+def to_micros(time):
+    return calendar.timegm(time.timetuple()) * 1000000 + time.microsecond
+
+
+def build_token(updated, entity_key):
+    return base64.urlsafe_b64encode("%d:%s" % (to_micros(updated), entity_key.urlsafe()))
+
+
+def parse_token(token):
+    """
+    Parse a sync token into (updated time, entity key), raises ValueError if the token is malformed.
+    """
+    if token is None:
+        return EPOCH, None
+    try:
+        micros, urlsafe_key = base64.urlsafe_b64decode(str(token)).split(':', 1)
+        return EPOCH + datetime.timedelta(microseconds=int(micros)), ndb.Key(urlsafe=urlsafe_key)
+    except (TypeError, ValueError, ProtocolBufferDecodeError):
+        raise ValueError("Invalid sync token %s." % token)
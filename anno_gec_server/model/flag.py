@@ -4,36 +4,29 @@ from google.appengine.ext import ndb
 
 from model.anno import Anno
 from model.base_model import BaseModel
+from model.legacy_key_migration import LegacyKeyMigrationMixin
 from message.flag_message import FlagMessage
 
 
-class Flag(BaseModel):
+class Flag(LegacyKeyMigrationMixin, BaseModel):
     """
     Flag data model.
     """
     anno_key = ndb.KeyProperty(kind=Anno)
     last_modified = ndb.DateTimeProperty(auto_now_add=True)
 
-    def to_message(self):
+    COUNTER_METRIC = 'flag_count'  # anno counter of flags, see LegacyKeyMigrationMixin.
+    LEGACY_KEYS_MIGRATED = False  # set it after migrate_keys finished, legacy flag queries are skipped then.
+
+    def to_message(self, creators=None):
         """
         Convert Flag data model to flag message.
+
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
         message = FlagMessage()
         message.id = self.key.id()
         message.anno_id = self.anno_key.id()
         message.created = self.created
-        if self.creator is not None:
-            message.creator = self.creator.get().to_message()
+        message.creator = self.get_creator_message(creators)
         return message
-
-    @classmethod
-    def is_belongs_user(cls, anno, user):
-        return Flag.query(Flag.anno_key == anno.key, Flag.creator == user.key).get() is not None
-
-    @classmethod
-    def query_flag_by_author(cls, user):
-        query = cls.query(cls.creator == user.key).order(-cls.created)
-        flag_list = []
-        for flag in query:
-            flag_list.append(flag)
-        return flag_list
\ No newline at end of file
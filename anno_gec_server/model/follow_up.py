@@ -1,5 +1,9 @@
 __author__ = 'topcircler'
 
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from model.anno import Anno
@@ -10,35 +14,95 @@ from message.followup_message import FollowupMessage
 class FollowUp(BaseModel):
     """
     Follow up data model.
+
+    A followup is a child of its anno, so followups of an anno can be listed by a strongly consistent
+    ancestor query. Legacy followups are root entities until migrate_to_anno_parent moves them.
     """
     comment = ndb.StringProperty()
     anno_key = ndb.KeyProperty(kind=Anno)
     last_modified = ndb.DateTimeProperty(auto_now_add=True)
 
-    def to_message(self):
+    LEGACY_KEYS_MIGRATED = False  # set it after migrate_to_anno_parent finished, ancestor queries are used then.
+
+    def to_message(self, creators=None):
         """
         Convert FollowUp data model to follow up message.
+
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
         message = FollowupMessage()
         message.id = self.key.id()
         message.anno_id = self.anno_key.id()
         message.comment = self.comment
         message.created = self.created
-        if self.creator is not None:
-            message.creator = self.creator.get().to_message()
+        message.creator = self.get_creator_message(creators)
         return message
 
     @classmethod
-    def find_by_anno(cls, anno):
-        followups = []
-        for followup in FollowUp.query(FollowUp.anno_key == anno.key):
-            followups.append(followup)
-        return followups
+    def get_by_message_id(cls, followup_id, anno_id=None):
+        """
+        Get a followup by the id and anno id of FollowupMessage, anno id can be omitted for legacy followups.
+        """
+        followup = None
+        if anno_id is not None:
+            followup = cls.get_by_id(followup_id, parent=ndb.Key(Anno, anno_id))
+        if followup is None and not cls.LEGACY_KEYS_MIGRATED:
+            followup = cls.get_by_id(followup_id)
+        return followup
+
+    @classmethod
+    def query_by_anno(cls, anno_key, limit, curs=None):
+        return cls.query_by_anno_async(anno_key, limit, curs).get_result()
+
+    @classmethod
+    def query_by_anno_async(cls, anno_key, limit, curs=None):
+        """
+        Query a page of followups of the given anno ordered by created.
+        Returns a future of (followup list, next cursor, more).
+        """
+        if cls.LEGACY_KEYS_MIGRATED:
+            query = cls.query(ancestor=anno_key)
+        else:
+            # legacy followups are not children of anno yet, the query by anno_key covers both.
+            query = cls.query(cls.anno_key == anno_key)
+        return query.order(cls.created).fetch_page_async(limit, start_cursor=curs)
 
     @classmethod
     def query_followup_by_author(cls, user):
-        query = cls.query(cls.creator == user.key).order(-cls.created)
-        followup_list = []
-        for followup in query:
-            followup_list.append(followup)
-        return followup_list
\ No newline at end of file
+        return cls.query_followup_by_author_async(user).get_result()
+
+    @classmethod
+    def query_followup_by_author_async(cls, user):
+        """
+        Async version of query_followup_by_author, returns a future of followup list.
+        """
+        return cls.query(cls.creator == user.key).order(-cls.created).fetch_async()
+
+    @classmethod
+    def migrate_to_anno_parent(cls, cursor=None, batch_size=100, migrated=0):
+        """
+        This method moves legacy followups under their annos, followup ids are kept.
+        Followups are processed batch by batch, each batch defers the next one.
+        Set LEGACY_KEYS_MIGRATED after it finishes.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many followups to process in one batch.
+        :param migrated: how many followups migrated in previous batches.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        followups, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        legacy_followups = [followup for followup in followups if followup.key.parent() is None]
+        new_keys = [ndb.Key(cls, followup.key.id(), parent=followup.anno_key) for followup in legacy_followups]
+        # a retried batch finds followups which are already moved.
+        existing_keys = set(followup.key for followup in ndb.get_multi(new_keys) if followup is not None)
+        new_followups = [cls(key=new_key, anno_key=followup.anno_key, creator=followup.creator,
+                             comment=followup.comment, created=followup.created,
+                             last_modified=followup.last_modified)
+                         for followup, new_key in zip(legacy_followups, new_keys) if new_key not in existing_keys]
+        ndb.put_multi(new_followups)
+        cls.delete_multi([followup.key for followup in legacy_followups])
+        migrated += len(legacy_followups)
+        if more and next_curs is not None:
+            deferred.defer(cls.migrate_to_anno_parent, cursor=next_curs.urlsafe(), batch_size=batch_size,
+                           migrated=migrated)
+        else:
+            logging.info("followup migration finished, %d followups moved under annos." % migrated)
\ No newline at end of file
@@ -0,0 +1,220 @@
+__author__ = 'topcircler'
+
+"""
+Shared logic of votes and flags, which are keyed by (user, anno), and migration of their legacy entities.
+"""
+
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.anno_counter import AnnoCounterShard
+
+
+class LegacyKeyMigrationMixin(object):
+    """
+    Mixin of models which are keyed by (user, anno): lookups, idempotent inserts and deletes by (user, anno),
+    and the move of their legacy entities with datastore ids to keys by (user, anno).
+
+    An entity is a child of its creator keyed by anno id, one entity group per user keeps concurrent writes
+    on a popular anno out of the anno entity group. Until LEGACY_KEYS_MIGRATED is set, legacy entities are
+    looked up by queries too.
+    A model using it defines anno_key, last_modified, COUNTER_METRIC (the anno counter which counts its entities)
+    and LEGACY_KEYS_MIGRATED.
+    """
+
+    @classmethod
+    def get_key(cls, anno_key, user_key):
+        """
+        Returns key of the entity of the given user on the given anno.
+        """
+        return ndb.Key(cls, anno_key.id(), parent=user_key)
+
+    @classmethod
+    def get_by_message_id(cls, message_id, user):
+        """
+        Get an entity by the id of its message, it's anno id for keyed entities and datastore id for legacy ones.
+        """
+        entity = cls.get_by_id(message_id, parent=user.key)
+        if entity is None and not cls.LEGACY_KEYS_MIGRATED:
+            entity = cls.get_by_id(message_id)
+        return entity
+
+    @classmethod
+    def is_belongs_user(cls, anno_key, user):
+        return cls.is_belongs_user_async(anno_key, user).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def is_belongs_user_async(cls, anno_key, user):
+        """
+        Async version of is_belongs_user, returns a future of bool.
+        """
+        entity = yield cls.get_key(anno_key, user.key).get_async()
+        if entity is None and not cls.LEGACY_KEYS_MIGRATED:
+            legacy_key = yield cls.query(cls.anno_key == anno_key, cls.creator == user.key).get_async(keys_only=True)
+            raise ndb.Return(legacy_key is not None)
+        raise ndb.Return(entity is not None)
+
+    @classmethod
+    def insert(cls, anno_key, user_key, created=None):
+        """
+        Insert an entity of the given user on the given anno, it's idempotent.
+        Returns (entity, inserted), inserted is False if the user already has one on the anno.
+        """
+        if not cls.LEGACY_KEYS_MIGRATED:
+            legacy_entity = cls.query(cls.anno_key == anno_key, cls.creator == user_key).get()
+            if legacy_entity is not None:
+                return legacy_entity, False
+        return cls._get_or_insert_multi([anno_key], user_key, [created])[0]
+
+    @classmethod
+    def insert_multi(cls, anno_keys, user_key, created_list):
+        """
+        Batch version of insert, entities of a user share one entity group so the batch is written in one transaction.
+        Returns a list of (entity, inserted) in the same order as anno_keys.
+        """
+        legacy_entities = {}
+        if not cls.LEGACY_KEYS_MIGRATED:
+            for entity in cls.query(cls.creator == user_key).fetch():
+                if entity.key.parent() is None:
+                    legacy_entities[entity.anno_key] = entity
+        new_items = [(anno_key, created) for anno_key, created in zip(anno_keys, created_list)
+                     if anno_key not in legacy_entities]
+        results = iter(cls._get_or_insert_multi([anno_key for anno_key, _ in new_items], user_key,
+                                                [created for _, created in new_items]))
+        return [(legacy_entities[anno_key], False) if anno_key in legacy_entities else next(results)
+                for anno_key in anno_keys]
+
+    @classmethod
+    @ndb.transactional
+    def _get_or_insert_multi(cls, anno_keys, user_key, created_list):
+        keys = [cls.get_key(anno_key, user_key) for anno_key in anno_keys]
+        entities = dict((key, entity) for key, entity in zip(keys, ndb.get_multi(keys)) if entity is not None)
+        results = []
+        new_entities = []
+        for key, anno_key, created in zip(keys, anno_keys, created_list):
+            if key in entities:
+                results.append((entities[key], False))
+                continue
+            entity = cls(key=key, anno_key=anno_key, creator=user_key)
+            if created is not None:
+                entity.created = created
+            entities[key] = entity
+            new_entities.append(entity)
+            results.append((entity, True))
+        ndb.put_multi(new_entities)
+        return results
+
+    @classmethod
+    def delete_by_user(cls, anno_key, user_key):
+        """
+        Delete the entity of the given user on the given anno, returns how many entities are deleted.
+        """
+        keys = []
+        key = cls.get_key(anno_key, user_key)
+        if cls._delete_if_exists(key):
+            keys.append(key)
+        if not cls.LEGACY_KEYS_MIGRATED:
+            legacy_keys = cls.query(cls.anno_key == anno_key, cls.creator == user_key).fetch(keys_only=True)
+            cls.delete_multi(legacy_keys)
+            keys.extend(legacy_keys)
+        return len(keys)
+
+    @classmethod
+    @ndb.transactional
+    def _delete_if_exists(cls, key):
+        if key.get() is None:
+            return False
+        cls.delete_multi([key])
+        return True
+
+    @classmethod
+    def delete_by_anno(cls, anno, user_keys=None):
+        """
+        Delete entities on the given anno, it's the bulk path of moderation. The anno counter is decreased by batch,
+        see AnnoCounterShard.delete_counted.
+        Returns creator keys of the deleted entities, activities are left to the caller.
+        :param user_keys: only entities of these users are deleted, all entities on the anno are deleted if it's None.
+        """
+        if user_keys is None:
+            keys = cls.query(cls.anno_key == anno.key).fetch(keys_only=True)
+        else:
+            keys = [cls.get_key(anno.key, user_key) for user_key in user_keys]
+            if not cls.LEGACY_KEYS_MIGRATED:
+                keys.extend(key for key in cls.query(cls.anno_key == anno.key).fetch(keys_only=True)
+                            if key.parent() is None)
+        return AnnoCounterShard.delete_counted(anno, keys, cls.COUNTER_METRIC, user_keys)
+
+    @classmethod
+    def query_by_author(cls, user):
+        return cls.query_by_author_async(user).get_result()
+
+    @classmethod
+    def query_by_author_async(cls, user):
+        """
+        Async version of query_by_author, returns a future of entity list.
+        """
+        return cls.query(cls.creator == user.key).order(-cls.created).fetch_async()
+
+    @classmethod
+    def migrate_keys(cls, cursor=None, batch_size=100, migrated=0, duplicated=0):
+        """
+        This method moves legacy entities to keys by (user, anno), duplicate entities of a user on an anno are
+        deleted and their anno counters are decreased. Entities are processed batch by batch, each batch defers
+        the next one. Set LEGACY_KEYS_MIGRATED after it finishes.
+        Each legacy entity is moved in its own transaction, so a retried batch doesn't decrease a counter twice.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many entities to process in one batch.
+        :param migrated: how many entities migrated in previous batches.
+        :param duplicated: how many duplicate entities deleted in previous batches.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        entities, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        legacy_entities = [entity for entity in entities if entity.key.parent() is None]
+        annos = dict((anno.key, anno) for anno in ndb.get_multi(list(set(entity.anno_key
+                                                                         for entity in legacy_entities)))
+                     if anno is not None)
+        for anno in annos.itervalues():
+            AnnoCounterShard.seed(anno, cls.COUNTER_METRIC)
+        duplicates = {}
+        for entity in legacy_entities:
+            duplicate = cls._migrate_legacy_entity(entity.key, entity.anno_key in annos)
+            if duplicate is None:
+                continue
+            if duplicate:
+                duplicates[entity.anno_key] = duplicates.get(entity.anno_key, 0) + 1
+            else:
+                migrated += 1
+        for anno_key, count in duplicates.iteritems():
+            if anno_key in annos:
+                AnnoCounterShard.counter_changed(anno_key, cls.COUNTER_METRIC, -count)
+        duplicated += sum(duplicates.values())
+        if more and next_curs is not None:
+            deferred.defer(cls.migrate_keys, cursor=next_curs.urlsafe(), batch_size=batch_size,
+                           migrated=migrated, duplicated=duplicated)
+        else:
+            logging.info("%s key migration finished, %d migrated, %d duplicates deleted."
+                         % (cls.__name__, migrated, duplicated))
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _migrate_legacy_entity(cls, legacy_key, anno_exists):
+        """
+        Move one legacy entity, the decrease of a duplicate's counter commits together with its delete.
+        Returns True if it's a deleted duplicate, False if it's moved, None if a previous run already moved it.
+        """
+        entity = legacy_key.get()
+        if entity is None:
+            return None
+        new_key = cls.get_key(entity.anno_key, entity.creator)
+        duplicate = new_key.get() is not None
+        if not duplicate:
+            cls(key=new_key, anno_key=entity.anno_key, creator=entity.creator, created=entity.created,
+                last_modified=entity.last_modified).put()
+        elif anno_exists:
+            AnnoCounterShard.increment_shard(entity.anno_key, cls.COUNTER_METRIC, -1)
+        cls.delete_multi([legacy_key])
+        return duplicate
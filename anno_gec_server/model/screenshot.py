@@ -0,0 +1,44 @@
+__author__ = 'topcircler'
+
+"""
+Screenshot data store model definition.
+"""
+
+import hashlib
+
+from google.appengine.ext import ndb
+
+
+class Screenshot(ndb.Model):
+    """
+    This class represents a screenshot image.
+
+    Screenshot is keyed by sha1 of its content, so identical screenshots are stored once.
+    """
+    image = ndb.BlobProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def get_key(cls, image):
+        return ndb.Key(cls, hashlib.sha1(image).hexdigest())
+
+    @classmethod
+    def save_images(cls, images):
+        """
+        Store the given image contents, only the ones which don't exist yet are written.
+        Returns screenshot keys in the same order as images.
+        """
+        keys = [cls.get_key(image) for image in images]
+        missing = {}
+        for key, image, screenshot in zip(keys, images, ndb.get_multi(keys)):
+            if screenshot is None:
+                missing[key] = cls(key=key, image=image)
+        ndb.put_multi(missing.values())
+        return keys
+
+    @classmethod
+    def save_image(cls, image):
+        """
+        Store the given image content, returns key of the screenshot.
+        """
+        return cls.save_images([image])[0]
@@ -0,0 +1,26 @@
+__author__ = 'topcircler'
+
+"""
+Session secret data store model definition.
+"""
+
+import binascii
+import os
+
+from google.appengine.ext import ndb
+
+
+class SessionSecret(ndb.Model):
+    """
+    This class represents the secret key which signs session tokens, it's a singleton generated on first use.
+    Deleting it invalidates all issued session tokens.
+    """
+    secret = ndb.StringProperty(required=True, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    SINGLETON_ID = 'session'
+
+    @classmethod
+    def get_secret(cls):
+        secret = cls.get_or_insert(cls.SINGLETON_ID, secret=binascii.hexlify(os.urandom(32)))
+        return secret.secret
@@ -1,10 +1,23 @@
 __author__ = 'topcircler'
 
+import logging
+
+import endpoints
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from message.user_message import UserMessage
 
 
+def normalize_email(email):
+    return email.strip().lower()
+
+
+def normalize_display_name(display_name):
+    return display_name.strip().lower()
+
+
 class User(ndb.Model):
     """
     Represents user entity.
@@ -14,37 +27,194 @@ class User(ndb.Model):
     password = ndb.StringProperty()
     auth_source = ndb.StringProperty()  # "Anno" or "Google". If not "Anno", then no password is stored.
 
+    EMAIL_INDEX_MIGRATED = False  # set it after build_unique_index finished, legacy queries are skipped then.
+
     @classmethod
     def find_user_by_email(cls, email):
-        return cls.query(User.user_email == email).get()
+        return cls.find_user_by_index(UserEmail.get_by_id(normalize_email(email)), 'user_email', email)
 
     @classmethod
     def find_user_by_display_name(cls, display_name):
-        return cls.query(User.display_name == display_name).get()
+        return cls.find_user_by_index(UserDisplayName.get_by_id(normalize_display_name(display_name)),
+                                      'display_name', display_name)
 
     @classmethod
-    def insert_user(cls, email):
-        user = User(display_name=email, user_email=email, auth_source='Google')
-        user.put()
+    def find_user_by_index(cls, index, name, value):
+        """
+        Find the user whose property of the given name is value by its unique index entity.
+        Users which lost a case collision to the index owner(see build_unique_index) are not indexed, they are
+        found by the legacy query.
+        """
+        if index is None:
+            return cls.query(getattr(cls, name) == value).get() if not cls.EMAIL_INDEX_MIGRATED else None
+        user = index.user_key.get()
+        if len(index.collided_user_keys) > 0 and (user is None or getattr(user, name) != value):
+            return cls.query(getattr(cls, name) == value).get() or user
         return user
 
     @classmethod
     def insert_normal_user(cls, email, username, password):
         user = User(user_email=email, display_name=username, password=password, auth_source="Anno")
-        user.put()
+        taken = cls.find_legacy_taken(user) or cls.put_unique(user)
+        if taken == 'user_email':
+            raise endpoints.BadRequestException("Email(" + email + ") already exists.")
+        if taken == 'display_name':
+            raise endpoints.BadRequestException("Display name(" + username + ") already exists.")
         return user
 
     @classmethod
-    def insert_user(cls, email, username, auth_source):
-        user = User(user_email=email, display_name=username, auth_source=auth_source)
-        user.put()
+    def insert_user(cls, email, username=None, auth_source='Google'):
+        """
+        Insert a user which isn't authenticated by anno password, the existing user is returned if the email is
+        already registered. display name is email by default.
+        """
+        user = User(user_email=email, display_name=username or email, auth_source=auth_source)
+        taken = cls.find_legacy_taken(user) or cls.put_unique(user)
+        if taken == 'user_email':
+            return cls.find_user_by_email(email)
+        if taken == 'display_name':
+            raise endpoints.BadRequestException("Display name(" + user.display_name + ") already exists.")
         return user
 
     @classmethod
-    def authenticate(cls, email, password):
-        query = User.query().filter(cls.user_email == email).filter(cls.password == password)
-        return query.get() is not None
+    def find_legacy_taken(cls, user):
+        """
+        Before build_unique_index finished, existing users may not be in unique indexes yet, query them instead.
+        Returns 'user_email' or 'display_name' which is already taken by another legacy user, otherwise None.
+        """
+        if cls.EMAIL_INDEX_MIGRATED:
+            return None
+        if cls.is_legacy_taken(User.user_email == user.user_email, user.key):
+            return 'user_email'
+        if cls.is_legacy_taken(User.display_name == user.display_name, user.key):
+            return 'display_name'
+        return None
+
+    @classmethod
+    def is_legacy_taken(cls, condition, user_key):
+        return any(key != user_key for key in cls.query(condition).fetch(2, keys_only=True))
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def put_unique(cls, user):
+        """
+        Save a new user and claim its email and display name in one transaction.
+        Returns None if the user is saved, otherwise 'user_email' or 'display_name' which is already taken.
+        """
+        email_key = ndb.Key(UserEmail, normalize_email(user.user_email))
+        display_name_key = ndb.Key(UserDisplayName, normalize_display_name(user.display_name))
+        user_email, user_display_name = ndb.get_multi([email_key, display_name_key])
+        if user_email is not None:
+            return 'user_email'
+        if user_display_name is not None:
+            return 'display_name'
+        user.put()
+        ndb.put_multi([UserEmail(key=email_key, user_key=user.key),
+                       UserDisplayName(key=display_name_key, user_key=user.key)])
+        return None
+
+    def change_display_name(self, display_name):
+        """
+        Change display name of current user, the new display name is claimed and the old one is released.
+        Returns False if the display name is taken by another user.
+        """
+        # legacy users are queried outside the transaction, queries in it must be ancestor queries.
+        renamed = User(key=self.key, user_email=self.user_email, display_name=display_name)
+        if User.find_legacy_taken(renamed) is not None:
+            return False
+        return self._change_display_name(display_name)
+
+    @ndb.transactional(xg=True)
+    def _change_display_name(self, display_name):
+        new_key = ndb.Key(UserDisplayName, normalize_display_name(display_name))
+        user_display_name = new_key.get()
+        if user_display_name is not None and user_display_name.user_key != self.key:
+            return False
+        if self.display_name is not None:
+            old_key = ndb.Key(UserDisplayName, normalize_display_name(self.display_name))
+            if old_key != new_key:
+                old_display_name = old_key.get()
+                if old_display_name is not None and old_display_name.user_key == self.key:
+                    old_key.delete()
+        UserDisplayName(key=new_key, user_key=self.key).put()
+        self.display_name = display_name
+        self.put()
+        return True
+
+    @classmethod
+    def build_unique_index(cls, cursor=None, batch_size=100, conflicts=0):
+        """
+        This method claims emails and display names of existing users, the first user claims a duplicate one.
+        Duplicates which differ only in case collide on the normalized index key, the other users are reported
+        and kept in collided_user_keys of the index entity, they are still found by the legacy query.
+        Users are processed batch by batch, each batch defers the next one. Set EMAIL_INDEX_MIGRATED after
+        it finishes.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many users to process in one batch.
+        :param conflicts: how many duplicate emails/display names found in previous batches.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        users, next_curs, more = cls.query().fetch_page(batch_size, start_cursor=curs)
+        claims = {}
+        for user in users:
+            if user.user_email is not None:
+                claims.setdefault(ndb.Key(UserEmail, normalize_email(user.user_email)), []).append(user.key)
+            if user.display_name is not None:
+                claims.setdefault(ndb.Key(UserDisplayName, normalize_display_name(user.display_name)),
+                                  []).append(user.key)
+        keys = claims.keys()
+        changed_entities = []
+        for key, index in zip(keys, ndb.get_multi(keys)):
+            changed = index is None
+            if index is None:
+                index = ndb.Model._lookup_model(key.kind())(key=key, user_key=claims[key][0])
+            # a retried batch finds its collisions already kept.
+            collided_user_keys = [user_key for user_key in claims[key]
+                                  if user_key != index.user_key and user_key not in index.collided_user_keys]
+            if len(collided_user_keys) > 0:
+                index.collided_user_keys.extend(collided_user_keys)
+                changed = True
+            if changed:
+                changed_entities.append(index)
+            for user_key in collided_user_keys:
+                conflicts += 1
+                logging.warning("user(%s) %s %s collides with user(%s), it's found by legacy query." %
+                                (user_key.id(), key.kind(), key.id(), index.user_key.id()))
+        ndb.put_multi(changed_entities)
+        if more and next_curs is not None:
+            deferred.defer(cls.build_unique_index, cursor=next_curs.urlsafe(), batch_size=batch_size,
+                           conflicts=conflicts)
+        else:
+            logging.info("user unique index finished, %d conflicts." % conflicts)
+
+    @classmethod
+    def get_user_message_map(cls, user_keys):
+        """
+        Fetch the given users with one batch get, returns a dict which maps user key to UserMessage.
+        """
+        user_keys = list(set([key for key in user_keys if key is not None]))
+        user_message_map = {}
+        for user in ndb.get_multi(user_keys):
+            if user is not None:
+                user_message_map[user.key] = user.to_message()
+        return user_message_map
 
     def to_message(self):
         return UserMessage(id=self.key.id(), user_email=self.user_email, display_name=self.display_name,
                            auth_source=self.auth_source)
+
+
+class UserEmail(ndb.Model):
+    """
+    Unique index of user email, it's keyed by normalized email.
+    """
+    user_key = ndb.KeyProperty(kind=User, indexed=False)
+    collided_user_keys = ndb.KeyProperty(kind=User, repeated=True, indexed=False)  # see build_unique_index.
+
+
+class UserDisplayName(ndb.Model):
+    """
+    Unique index of user display name, it's keyed by normalized display name.
+    """
+    user_key = ndb.KeyProperty(kind=User, indexed=False)
+    collided_user_keys = ndb.KeyProperty(kind=User, repeated=True, indexed=False)  # see build_unique_index.
@@ -0,0 +1,174 @@
+__author__ = 'topcircler'
+
+"""
+Materialized index of the annos a user is involved in, it backs anno.mystuff.
+"""
+
+import datetime
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.anno import Anno
+from model.vote import Vote
+from model.flag import Flag
+from model.follow_up import FollowUp
+from model.user import User
+
+
+class UserAnnoActivity(ndb.Model):
+    """
+    This class represents a user's involvement in an anno.
+
+    It's a child of the user keyed by anno id, so a user's "my stuff" list is one ancestor query ordered by
+    last interaction time. It's written by anno/vote/flag/followup insert and delete, and deleted when the user
+    has no involvement left or the anno is deleted.
+    """
+    anno_key = ndb.KeyProperty(kind=Anno)
+    is_author = ndb.BooleanProperty(default=False, indexed=False)
+    voted = ndb.BooleanProperty(default=False, indexed=False)
+    flagged = ndb.BooleanProperty(default=False, indexed=False)
+    followup_count = ndb.IntegerProperty(default=0, indexed=False)
+    last_interaction_time = ndb.DateTimeProperty()
+    last_interaction_type = ndb.StringProperty(indexed=False)  # 'anno', 'vote', 'flag' or 'followup'.
+
+    @classmethod
+    def get_key(cls, user_key, anno_key):
+        return ndb.Key(cls, anno_key.id(), parent=user_key)
+
+    def is_empty(self):
+        return not (self.is_author or self.voted or self.flagged or self.followup_count > 0)
+
+    def apply(self, activity_type, interaction_time):
+        """
+        Apply an interaction of the given type, interaction time only moves forward.
+        """
+        if activity_type == 'anno':
+            self.is_author = True
+        elif activity_type == 'vote':
+            self.voted = True
+        elif activity_type == 'flag':
+            self.flagged = True
+        elif activity_type == 'followup':
+            self.followup_count += 1
+        if self.last_interaction_time is None or interaction_time >= self.last_interaction_time:
+            self.last_interaction_time = interaction_time
+            self.last_interaction_type = activity_type
+
+    @classmethod
+    def record(cls, user_key, anno_key, activity_type, interaction_time=None):
+        """
+        Record an interaction of a user with an anno.
+        :param activity_type: 'anno', 'vote', 'flag' or 'followup'.
+        :param interaction_time: time of the interaction, default is now.
+        """
+        cls.record_multi(user_key, [(anno_key, activity_type, interaction_time)])
+
+    @classmethod
+    @ndb.transactional
+    def record_multi(cls, user_key, interactions):
+        """
+        Record interactions of a user in one transaction, activities of the user share one entity group.
+        :param interactions: list of (anno key, activity type, interaction time or None).
+        """
+        keys = [cls.get_key(user_key, anno_key) for anno_key, _, _ in interactions]
+        activities = dict((key, activity) for key, activity in zip(keys, ndb.get_multi(keys)) if activity is not None)
+        for key, (anno_key, activity_type, interaction_time) in zip(keys, interactions):
+            if key not in activities:
+                activities[key] = cls(key=key, anno_key=anno_key)
+            activities[key].apply(activity_type, interaction_time or datetime.datetime.now())
+        ndb.put_multi(activities.values())
+
+    @classmethod
+    @ndb.transactional
+    def remove(cls, user_key, anno_key, activity_type):
+        """
+        Remove an interaction of a user with an anno, the activity is deleted if no involvement is left.
+        Last interaction time isn't changed.
+        """
+        key = cls.get_key(user_key, anno_key)
+        activity = key.get()
+        if activity is None:
+            return
+        if activity_type == 'anno':
+            activity.is_author = False
+        elif activity_type == 'vote':
+            activity.voted = False
+        elif activity_type == 'flag':
+            activity.flagged = False
+        elif activity_type == 'followup':
+            activity.followup_count = max(activity.followup_count - 1, 0)
+        if activity.is_empty():
+            key.delete()
+        else:
+            activity.put()
+
+    @classmethod
+    def remove_multi(cls, user_keys, anno_key, activity_type):
+        """
+        Remove an interaction of many users with an anno, each user is removed in its own transaction.
+        It's deferred by bulk deletes of votes and flags.
+        """
+        for user_key in user_keys:
+            cls.remove(user_key, anno_key, activity_type)
+
+    @classmethod
+    def query_by_user(cls, user, limit, curs):
+        """
+        Returns a page of annos the given user is involved in, ordered by last interaction time desc.
+        Activities of annos which no longer exist are skipped, and deleted by a deferred task.
+        :returns: (anno list, next cursor, more)
+        """
+        query = cls.query(ancestor=user.key).order(-cls.last_interaction_time)
+        activities, next_curs, more = query.fetch_page(limit, start_cursor=curs)
+        annos = ndb.get_multi([activity.anno_key for activity in activities])
+        stale_keys = [activity.key for activity, anno in zip(activities, annos) if anno is None]
+        if len(stale_keys) > 0:
+            deferred.defer(ndb.delete_multi, stale_keys)
+        return [anno for anno in annos if anno is not None], next_curs, more
+
+    @classmethod
+    @ndb.tasklet
+    def build_by_user_async(cls, user):
+        """
+        Tasklet which builds activities of the given user from its annos, votes, flags and followups.
+        Activities of annos which no longer exist are left out. Returns a future of activity list.
+        """
+        annos, votes, flags, followups = yield (Anno.query_anno_by_author_async(user),
+                                                Vote.query_by_author_async(user),
+                                                Flag.query_by_author_async(user),
+                                                FollowUp.query_followup_by_author_async(user))
+        activities = {}
+        for activity_type, entities in [('anno', annos), ('vote', votes), ('flag', flags), ('followup', followups)]:
+            for entity in entities:
+                anno_key = entity.key if activity_type == 'anno' else entity.anno_key
+                if anno_key not in activities:
+                    activities[anno_key] = cls(key=cls.get_key(user.key, anno_key), anno_key=anno_key)
+                activities[anno_key].apply(activity_type, entity.created or datetime.datetime.now())
+        own_anno_keys = set(anno.key for anno in annos)
+        referenced_keys = [anno_key for anno_key in activities if anno_key not in own_anno_keys]
+        referenced_annos = yield ndb.get_multi_async(referenced_keys)
+        for anno_key, anno in zip(referenced_keys, referenced_annos):
+            if anno is None:
+                del activities[anno_key]
+        raise ndb.Return(activities.values())
+
+    @classmethod
+    def backfill(cls, cursor=None, batch_size=20):
+        """
+        This method builds activities of all existing users.
+        Users are processed batch by batch, each batch defers the next one.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many users to process in one batch.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        users, next_curs, more = User.query().fetch_page(batch_size, start_cursor=curs)
+        futures = [cls.build_by_user_async(user) for user in users]
+        for future in futures:
+            ndb.put_multi(future.get_result())
+        if more and next_curs is not None:
+            deferred.defer(cls.backfill, cursor=next_curs.urlsafe(), batch_size=batch_size)
+        else:
+            logging.info("user anno activity backfill finished.")
@@ -0,0 +1,113 @@
+__author__ = 'topcircler'
+
+"""
+Materialized set of apps a user is involved in.
+"""
+
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from model.anno import Anno
+from model.vote import Vote
+from model.flag import Flag
+from model.follow_up import FollowUp
+from model.user import User
+
+
+@ndb.tasklet
+def get_related_annos_async(user):
+    """
+    Tasklet which gets annos created, voted, flagged or followed up by the given user.
+
+    The four author queries run concurrently, then all referenced annos are fetched by one get_multi.
+    Returns a future of anno list without duplicates.
+    """
+    annos, votes, flags, followups = yield (Anno.query_anno_by_author_async(user),
+                                            Vote.query_by_author_async(user),
+                                            Flag.query_by_author_async(user),
+                                            FollowUp.query_followup_by_author_async(user))
+    anno_keys = set(anno.key for anno in annos)
+    referenced_keys = []
+    for entity in votes + flags + followups:
+        if entity.anno_key not in anno_keys:
+            anno_keys.add(entity.anno_key)
+            referenced_keys.append(entity.anno_key)
+    referenced_annos = yield ndb.get_multi_async(referenced_keys)
+    raise ndb.Return(annos + [anno for anno in referenced_annos if anno is not None])
+
+
+class UserAppSet(ndb.Model):
+    """
+    This class represents names of the apps in which a user created, voted, flagged or followed up annos.
+    It's keyed by user id, so anno.search only_my_apps costs one key lookup.
+
+    Insert paths add app names incrementally, deletes don't remove them, the set is only corrected by rebuild.
+    A user's set is built on first read, rebuild_all rebuilds the sets of all users.
+    """
+    app_names = ndb.StringProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_key(cls, user_key):
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def get_app_names(cls, user):
+        """
+        Returns set of app names of the given user, the set is built if it's not materialized yet.
+        """
+        app_set = cls.get_key(user.key).get()
+        if app_set is None:
+            app_set = cls.rebuild(user)
+        return set(app_set.app_names)
+
+    @classmethod
+    def add_app_name(cls, user_key, app_name):
+        """
+        Add an app name into the set of the given user, it's called by anno/vote/flag/followup insert.
+        """
+        if app_name is None:
+            return
+        app_set = cls.get_key(user_key).get()
+        # a set which isn't materialized yet is built on first read, it will contain this app.
+        if app_set is not None and app_name not in app_set.app_names:
+            cls._add_app_name(user_key, app_name)
+
+    @classmethod
+    @ndb.transactional
+    def _add_app_name(cls, user_key, app_name):
+        app_set = cls.get_key(user_key).get()
+        if app_set is not None and app_name not in app_set.app_names:
+            app_set.app_names.append(app_name)
+            app_set.put()
+
+    @classmethod
+    def rebuild(cls, user):
+        """
+        Build app set of the given user from the annos the user is involved in.
+        """
+        annos = get_related_annos_async(user).get_result()
+        app_names = sorted(set(anno.app_name for anno in annos if anno.app_name is not None))
+        app_set = cls(key=cls.get_key(user.key), app_names=app_names)
+        app_set.put()
+        return app_set
+
+    @classmethod
+    def rebuild_all(cls, cursor=None, batch_size=20):
+        """
+        This method rebuilds app sets of all existing users.
+        Users are processed batch by batch, each batch defers the next one.
+        :param cursor: urlsafe cursor of the next batch.
+        :param batch_size: how many users to process in one batch.
+        """
+        curs = Cursor(urlsafe=cursor) if cursor is not None else None
+        users, next_curs, more = User.query().fetch_page(batch_size, start_cursor=curs)
+        for user in users:
+            cls.rebuild(user)
+        if more and next_curs is not None:
+            deferred.defer(cls.rebuild_all, cursor=next_curs.urlsafe(), batch_size=batch_size)
+        else:
+            logging.info("user app set rebuild finished.")
@@ -5,36 +5,29 @@ from google.appengine.ext import ndb
 from model.anno import Anno
 
 from model.base_model import BaseModel
+from model.legacy_key_migration import LegacyKeyMigrationMixin
 from message.vote_message import VoteMessage
 
 
-class Vote(BaseModel):
+class Vote(LegacyKeyMigrationMixin, BaseModel):
     """
     Vote data model.
     """
     anno_key = ndb.KeyProperty(kind=Anno)
     last_modified = ndb.DateTimeProperty(auto_now_add=True)
 
-    def to_message(self):
+    COUNTER_METRIC = 'vote_count'  # anno counter of votes, see LegacyKeyMigrationMixin.
+    LEGACY_KEYS_MIGRATED = False  # set it after migrate_keys finished, legacy vote queries are skipped then.
+
+    def to_message(self, creators=None):
         """
         Convert Vote data model to vote message.
+
+        :param creators: creators resolved by BaseModel.resolve_creators, optional.
         """
         message = VoteMessage()
         message.id = self.key.id()
         message.anno_id = self.anno_key.id()
         message.created = self.created
-        if self.creator is not None:
-            message.creator = self.creator.get().to_message()
+        message.creator = self.get_creator_message(creators)
         return message
-
-    @classmethod
-    def is_belongs_user(cls, anno, user):
-        return Vote.query(Vote.anno_key == anno.key, Vote.creator == user.key).get() is not None
-
-    @classmethod
-    def query_vote_by_author(cls, user):
-        query = cls.query(cls.creator == user.key).order(-cls.created)
-        vote_list = []
-        for vote in query:
-            vote_list.append(vote)
-        return vote_list
\ No newline at end of file
@@ -9,6 +9,8 @@ from api.followup_api import FollowupApi
 from api.user_api import UserApi
 from api.account_api import AccountApi
 from api.util_api import UtilApi
+from api.sync_api import SyncApi
 
-APPLICATION = endpoints.api_server([VoteApi, AnnoApi, FlagApi, FollowupApi, UserApi, AccountApi, UtilApi],
+APPLICATION = endpoints.api_server([VoteApi, AnnoApi, FlagApi, FollowupApi, UserApi, AccountApi, UtilApi,
+                                    SyncApi],
                                    restricted=False)
\ No newline at end of file